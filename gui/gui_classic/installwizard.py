@@ -222,8 +222,9 @@ class InstallWizard(QDialog):
             return
 
         else:
-            self.config.set_key("server", None, True)
-            self.config.set_key('auto_cycle', False, True)
+            with self.config.batch():
+                self.config.set_key("server", None, True)
+                self.config.set_key('auto_cycle', False, True)
             return
         
         
@@ -260,6 +261,7 @@ class InstallWizard(QDialog):
             wallet.storage.put('seed_version', wallet.seed_version, True)
         else:
             wallet.accounts.pop(0)
+            wallet.rebuild_address_index()
             wallet.create_accounts()
             wallet.set_up_to_date(False)
             wallet.interface.poke('synchronizer')
@@ -23,7 +23,7 @@ import os.path
 import random
 import re
 import time
-from electrum.wallet import Wallet, WalletStorage
+from electrum import Wallet, WalletStorage
 import webbrowser
 import history_widget
 import receiving_widget
@@ -292,6 +292,11 @@ class ElectrumWindow(QMainWindow):
         self.load_wallet(wallet)
 
 
+    def backup_wallet(self):
+        # fold the journal into the wallet file before copying it
+        self.wallet.storage.write()
+        backup_wallet(self.wallet.storage.path)
+
     def new_wallet(self):
         import installwizard
 
@@ -320,7 +325,7 @@ class ElectrumWindow(QMainWindow):
         new_wallet_action.triggered.connect(self.new_wallet)
 
         wallet_backup = file_menu.addAction(_("&Copy"))
-        wallet_backup.triggered.connect(lambda: backup_wallet(self.wallet.storage.path))
+        wallet_backup.triggered.connect(self.backup_wallet)
 
         quit_item = file_menu.addAction(_("&Close"))
         quit_item.triggered.connect(self.close)
@@ -481,12 +486,12 @@ class ElectrumWindow(QMainWindow):
         old_text = self.wallet.labels.get(name)
         if text:
             if old_text != text:
-                self.wallet.labels[name] = text
-                self.wallet.storage.put('labels', self.wallet.labels)
+                self.wallet.set_label(name, text)
                 changed = True
         else:
             if old_text:
                 self.wallet.labels.pop(name)
+                self.wallet.storage.pop_item('labels', name)
                 changed = True
         self.run_hook('set_label', name, text, changed)
         return changed
@@ -1877,8 +1882,9 @@ class ElectrumWindow(QMainWindow):
             f = open(labelsFile, 'r')
             data = f.read()
             f.close()
-            for key, value in json.loads(data).items():
-                self.wallet.set_label(key, value)
+            with self.wallet.storage.batch():
+                for key, value in json.loads(data).items():
+                    self.wallet.set_label(key, value)
             QMessageBox.information(None, _("Labels imported"), _("Your labels were imported from")+" '%s'" % str(labelsFile))
         except (IOError, os.error), reason:
             QMessageBox.critical(None, _("Unable to import labels"), _("Electrum was unable to import your labels.")+"\n" + str(reason))
@@ -2163,8 +2169,9 @@ class ElectrumWindow(QMainWindow):
 
     def closeEvent(self, event):
         g = self.geometry()
-        self.config.set_key("winpos-qt", [g.left(),g.top(),g.width(),g.height()], True)
-        self.save_column_widths()
-        self.config.set_key("console-history", self.console.history[-50:], True)
+        with self.config.batch():
+            self.config.set_key("winpos-qt", [g.left(),g.top(),g.width(),g.height()], True)
+            self.save_column_widths()
+            self.config.set_key("console-history", self.console.history[-50:], True)
         event.accept()
 
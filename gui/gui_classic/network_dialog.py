@@ -52,6 +52,11 @@ class NetworkDialog(QDialog):
 
             if interface.is_connected:
                 status += "\n" + _("Main server:") + " %s"%(interface.host) 
+                s = network.get_server_status().get(interface.server)
+                if s and s['rtt'] is not None:
+                    status += "\n" + _("Round trip:") + " %d ms"%(1000*s['rtt'])
+                if s and s['handshake_time']:
+                    status += ", " + _("SSL handshake:") + " %d ms"%(1000*s['handshake_time'])
             else:
                 status += "\n" + _("Disconnected from main server")
                 
@@ -236,8 +241,9 @@ class NetworkDialog(QDialog):
         else:
             proxy = None
 
-        self.config.set_key("proxy", proxy, True)
-        self.config.set_key("server", server, True)
-        self.network.set_server(server, proxy)
-        self.config.set_key('auto_cycle', self.autocycle_cb.isChecked(), True)
+        with self.config.batch():
+            self.config.set_key("proxy", proxy, True)
+            self.config.set_key("server", server, True)
+            self.network.set_server(server, proxy)
+            self.config.set_key('auto_cycle', self.autocycle_cb.isChecked(), True)
         return True
@@ -1,14 +1,15 @@
 from version import ELECTRUM_VERSION
 from util import format_satoshis, print_msg, print_json, print_error, set_verbosity
-from wallet import WalletSynchronizer, WalletStorage
+from wallet import WalletSynchronizer
 from wallet_factory import WalletFactory as Wallet
+from wallet_factory import WalletStorageFactory as WalletStorage
 from verifier import TxVerifier
 from network import Network
 from interface import Interface, pick_random_server, DEFAULT_SERVERS
 from simple_config import SimpleConfig
 import bitcoin
 import account
-from transaction import Transaction
+from transaction import Transaction, start_pool
 from plugins import BasePlugin
 from mnemonic import mn_encode as mnemonic_encode
 from mnemonic import mn_decode as mnemonic_decode
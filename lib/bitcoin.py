@@ -17,7 +17,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import hashlib, base64, ecdsa, re
+import hashlib, base64, ecdsa, re, threading
 from util import print_error
 
 def rev_hex(s):
@@ -106,6 +106,94 @@ def i2o_ECPublicKey(pubkey, compressed=False):
             
 ############ functions from pywallet ##################### 
 
+class LRUCache(object):
+    """bounded cache for the results of a pure function of one argument.
+    the least recently used entries are dropped first. the entries are
+    in a circular doubly linked list, the most recently used last."""
+
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, func, size):
+        self.func = func
+        self.size = size
+        self.data = {}              # key -> [prev, next, key, value]
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key):
+        if type(key) is buffer:
+            key = str(key)
+        with self.lock:
+            link = self.data.get(key)
+            if link is not None:
+                self.hits += 1
+                self.unlink(link)
+                self.append(link)
+                return link[self.VALUE]
+            self.misses += 1
+        value = self.func(key)
+        with self.lock:
+            link = self.data.get(key)
+            if link is not None:
+                self.unlink(link)
+            link = [None, None, key, value]
+            self.data[key] = link
+            self.append(link)
+            while len(self.data) > self.size:
+                oldest = self.root[self.NEXT]
+                self.unlink(oldest)
+                del self.data[oldest[self.KEY]]
+        return value
+
+    def unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def append(self, link):
+        last = self.root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self.root
+        last[self.NEXT] = self.root[self.PREV] = link
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = self.misses = 0
+
+    def stats(self):
+        n = self.hits + self.misses
+        return { 'size':len(self.data), 'hits':self.hits, 'misses':self.misses, 'hit_rate':float(self.hits)/n if n else 0. }
+
+
+ADDRESS_CACHE_SIZE = 20000
+
+def _public_key_to_bc_address(public_key):
+    h160 = hash_160(public_key)
+    return hash_160_to_bc_address(h160)
+
+def _hash_160_to_bc_address(vh160):
+    h = Hash(vh160)
+    addr = vh160 + h[0:4]
+    return b58encode(addr)
+
+def _bc_address_to_hash_160(addr):
+    bytes = b58decode(addr, 25)
+    return ord(bytes[0]), bytes[1:21]
+
+pubkey_address_cache = LRUCache(_public_key_to_bc_address, ADDRESS_CACHE_SIZE)
+hash160_address_cache = LRUCache(_hash_160_to_bc_address, ADDRESS_CACHE_SIZE)
+address_hash160_cache = LRUCache(_bc_address_to_hash_160, ADDRESS_CACHE_SIZE)
+
+def address_cache_stats():
+    return { 'public_key_to_bc_address': pubkey_address_cache.stats(),
+             'hash_160_to_bc_address': hash160_address_cache.stats(),
+             'bc_address_to_hash_160': address_hash160_cache.stats() }
+
+
 def hash_160(public_key):
     try:
         md = hashlib.new('ripemd160')
@@ -118,18 +206,13 @@ def hash_160(public_key):
 
 
 def public_key_to_bc_address(public_key):
-    h160 = hash_160(public_key)
-    return hash_160_to_bc_address(h160)
+    return pubkey_address_cache(public_key)
 
 def hash_160_to_bc_address(h160, addrtype = 0):
-    vh160 = chr(addrtype) + h160
-    h = Hash(vh160)
-    addr = vh160 + h[0:4]
-    return b58encode(addr)
+    return hash160_address_cache(chr(addrtype) + str(h160))
 
 def bc_address_to_hash_160(addr):
-    bytes = b58decode(addr, 25)
-    return ord(bytes[0]), bytes[1:21]
+    return address_hash160_cache(addr)
 
 def encode_point(pubkey, compressed=False):
     order = generator_secp256k1.order()
@@ -21,6 +21,8 @@ import threading, time, Queue, os, sys, shutil
 from util import user_dir, appdata_dir, print_error
 from bitcoin import *
 
+BAD_SERVER_TIMEOUT = 600   # seconds before a server that sent bad headers is trusted again
+
 
 class Blockchain(threading.Thread):
 
@@ -37,6 +39,10 @@ class Blockchain(threading.Thread):
         self.set_local_height()
         self.queue = Queue.Queue()
         self.servers_height = {}
+        self.servers_tip = {}         # server -> (height, hash, header) of its last notification
+        self.bad_servers = {}         # server -> time it failed to deliver a valid chain
+        self.tip_hash = None          # hash of the last tip that was verified and saved
+        self.reorg_height = None      # lowest height of the headers replaced by the last reorg
 
     
     def stop(self):
@@ -65,38 +71,176 @@ class Blockchain(threading.Thread):
             if not result: continue
 
             i, result = result
-            header = result.get('result')
-            height = header.get('block_height')
+            self.update_tip(i, result.get('result'))
+
+            # every server announces the same block: take the notifications
+            # that are already queued into account before doing any work
+            while True:
+                try:
+                    result = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if result:
+                    self.update_tip(result[0], result[1].get('result'))
+
+            tips = self.get_candidate_tips()
+            if not tips: continue
+
+            if tips[0][1] == self.tip_hash:
+                # already verified and saved; the other notifications only
+                # updated the height and agreement state of their server
+                self.check_main_server(tips[0][0])
+                continue
+
+            # servers that cannot deliver a valid chain for the best tip are
+            # marked bad, and the next tip is tried
+            for tip in tips:
+                if self.sync_tip(tip) or not self.is_running():
+                    break
+
+            self.check_main_server(tips[0][0])
+
+
+    def sync_tip(self, tip):
+        """fetch and verify the headers up to tip from the servers that
+        announced it, fastest first. return False if none of them could"""
+        height, _hash, header = tip
+        if height <= self.local_height:
+            local_header = self.read_header(height)
+            if local_header and self.hash_header(local_header) == _hash:
+                self.tip_hash = _hash
+            return True
+
+        for i in self.get_agreeing_interfaces(tip):
+            if self.sync_from(i, tip):
+                return True
+            if not self.is_running():
+                return False
+            print_error("error", i.server)
+            self.mark_bad_server(i.server)
+        return False
+
+
+    def sync_from(self, i, tip):
+        height, _hash, header = tip
+        if height > self.local_height + 50:
+            if not self.get_chunks(i, header, height):
+                return False
+            self.network.trigger_callback('updated')
+
+        # get missing parts from interface (until it connects to my chain)
+        chain = self.get_chain( i, header )
+        if not chain or not self.verify_chain( chain ):
+            return False
+
+        print_error("height:", height, i.server)
+        local_height = self.local_height
+        for header in chain:
+            self.save_header(header)
+            self.height = height
+        self.tip_hash = _hash
+        fork_height = chain[0].get('block_height')
+        if fork_height <= local_height:
+            self.reorg(fork_height)
+        self.network.trigger_callback('updated')
+        return True
+
+
+    def mark_bad_server(self, server):
+        with self.lock:
+            self.bad_servers[server] = time.time()
+
+
+    def get_bad_servers(self):
+        # must be called with self.lock held
+        now = time.time()
+        for server, t in self.bad_servers.items():
+            if now - t > BAD_SERVER_TIMEOUT:
+                self.bad_servers.pop(server)
+        return self.bad_servers
+
+
+    def server_connected(self, server):
+        """a new connection to server: forget its previous tip and failures"""
+        with self.lock:
+            self.bad_servers.pop(server, None)
+            self.servers_tip.pop(server, None)
+
+
+    def check_main_server(self, height):
+        server = self.network.interface.server
+        if server in self.get_divergent_servers():
+            print "server is lagging", height, self.servers_height.get(server)
+            self.network.interface.stop()
+
+
+    def update_tip(self, i, header):
+        height = header.get('block_height')
+        with self.lock:
             self.servers_height[i.server] = height
+            self.servers_tip[i.server] = (height, self.hash_header(header), header)
 
-            if height > self.local_height + 50:
-                self.get_chunks(i, header, height)
-                self.network.trigger_callback('updated')
 
-            if height > self.local_height:
-                # get missing parts from interface (until it connects to my chain)
-                chain = self.get_chain( i, header )
+    def get_candidate_tips(self):
+        """(height, hash, header) of the tips announced by connected servers,
+        the one with the most work first. the number of servers that agree on
+        a tip decides between competing tips at the same height"""
+        servers = self.network.interfaces.keys()
+        votes = {}
+        tips = {}
+        with self.lock:
+            bad = self.get_bad_servers()
+            for server, tip in self.servers_tip.items():
+                if server not in servers or server in bad:
+                    continue
+                height, _hash, header = tip
+                votes[_hash] = votes.get(_hash, 0) + 1
+                tips[_hash] = tip
+        hashes = sorted(votes.keys(), key=lambda h: (tips[h][0], votes[h]), reverse=True)
+        return [ tips[h] for h in hashes ]
 
-                # skip that server if the result is not consistent
-                if not chain: continue
-                
-                # verify the chain
-                if self.verify_chain( chain ):
-                    print_error("height:", height, i.server)
-                    for header in chain:
-                        self.save_header(header)
-                        self.height = height
-                else:
-                    print_error("error", i.server)
-                    # todo: dismiss that server
 
-                self.network.trigger_callback('updated')
+    def get_consensus_tip(self):
+        tips = self.get_candidate_tips()
+        if tips:
+            return tips[0]
+
+
+    def get_agreeing_servers(self, tip):
+        height, _hash, header = tip
+        with self.lock:
+            bad = self.get_bad_servers()
+            return [server for server, t in self.servers_tip.items() if t[1] == _hash and server not in bad]
+
+
+    def get_divergent_servers(self):
+        """servers that sent bad headers, are on another branch than the
+        consensus, or are more than one block behind it"""
+        tip = self.get_consensus_tip()
+        if not tip: return []
+        height, _hash, header = tip
+        out = []
+        with self.lock:
+            bad = self.get_bad_servers()
+            for server, t in self.servers_tip.items():
+                if server in bad:
+                    out.append(server)
+                elif t[1] == _hash:
+                    continue
+                elif t[0] == height - 1 and t[1] == header.get('prev_block_hash'):
+                    # one block behind, on the same branch
+                    continue
+                else:
+                    out.append(server)
+        return out
 
-            h = self.servers_height.get(self.network.interface.server)
-            if h is not None and h < height - 1:
-                print "server is lagging", height, h
-                self.network.interface.stop()
 
+    def get_agreeing_interfaces(self, tip):
+        """connected interfaces that announced tip, lowest round-trip time first"""
+        interfaces = [ self.network.interfaces.get(server) for server in self.get_agreeing_servers(tip) ]
+        interfaces = [ i for i in interfaces if i and i.is_connected ]
+        unknown = 1e9
+        return sorted(interfaces, key=lambda i: i.rtt if i.rtt is not None else unknown)
 
                     
             
@@ -155,36 +299,12 @@ class Blockchain(threading.Thread):
         print_error("validated chunk %d"%height)
 
 
-    def verify_header(self, header):
-        # add header to the blockchain file
-        # if there is a reorg, push it in a stack
-
-        height = header.get('block_height')
-
-        prev_header = self.read_header(height -1)
-        if not prev_header:
-            # return False to request previous header
-            return False
-
-        prev_hash = self.hash_header(prev_header)
-        bits, target = self.get_target(height/2016)
-        _hash = self.hash_header(header)
-        try:
-            assert prev_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
-            assert eval('0x'+_hash) < target
-        except:
-            # this can be caused by a reorg.
-            print_error("verify header failed"+ repr(header))
-            verifier.undo_verifications()
+    def reorg(self, height):
+        """ headers from height on have been replaced """
+        print_error("reorg at height", height)
+        self.reorg_height = height
+        self.network.trigger_callback('reorg')
 
-            # return False to request previous header.
-            return False
-
-        self.save_header(header)
-        print_error("verify header:", _hash, height)
-        return True
-        
 
     def header_to_string(self, res):
         s = int_to_hex(res.get('version'),4) \
@@ -312,8 +432,8 @@ class Blockchain(threading.Thread):
         print_error("requesting header %d from %s"%(h, i.server))
         i.send([ ('blockchain.block.get_header',[h])], 'get_header')
 
-    def retrieve_header(self, i):
-        while True:
+    def retrieve_header(self, i, height):
+        while i.is_connected and self.is_running():
             try:
                 r = i.get_response('get_header',timeout=1)
             except Queue.Empty:
@@ -322,14 +442,16 @@ class Blockchain(threading.Thread):
 
             if r.get('error'):
                 print_error('Verifier received an error:', r)
-                continue
+                self.drain_responses(i)
+                return
 
             # 3. handle response
             method = r['method']
             params = r['params']
             result = r['result']
 
-            if method == 'blockchain.block.get_header':
+            # replies to earlier requests that were given up are skipped
+            if method == 'blockchain.block.get_header' and params[0] == height:
                 return result
                 
 
@@ -343,7 +465,7 @@ class Blockchain(threading.Thread):
         while self.is_running():
 
             if requested_header:
-                header = self.retrieve_header(interface)
+                header = self.retrieve_header(interface, height - 1)
                 if not header: return
                 chain = [ header ] + chain
                 requested_header = False
@@ -379,6 +501,8 @@ class Blockchain(threading.Thread):
             break
 
         while requested_chunks:
+            if not i.is_connected or not self.is_running():
+                return False
             try:
                 r = i.get_response('get_header',timeout=1)
             except Queue.Empty:
@@ -387,7 +511,8 @@ class Blockchain(threading.Thread):
 
             if r.get('error'):
                 print_error('Verifier received an error:', r)
-                continue
+                self.drain_responses(i)
+                return False
 
             # 3. handle response
             method = r['method']
@@ -396,9 +521,28 @@ class Blockchain(threading.Thread):
 
             if method == 'blockchain.block.get_chunk':
                 index = params[0]
-                self.verify_chunk(index, result)
+                if index not in requested_chunks:
+                    # reply to an earlier request that was given up
+                    continue
+                try:
+                    self.verify_chunk(index, result)
+                except:
+                    print_error("bad chunk %d from %s"%(index, i.server))
+                    self.drain_responses(i)
+                    return False
                 requested_chunks.remove(index)
 
+        return True
+
+
+    def drain_responses(self, i):
+        # drop the replies that are already queued for a request that failed
+        while True:
+            try:
+                i.get_response('get_header', block=False)
+            except Queue.Empty:
+                return
+
 
 
 
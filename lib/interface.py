@@ -19,14 +19,29 @@
 
 import random, socket, ast, re, ssl, errno
 import threading, traceback, sys, time, json, Queue
+from collections import deque
 
 from version import ELECTRUM_VERSION, PROTOCOL_VERSION
 from util import print_error, print_msg
 
 
 DEFAULT_TIMEOUT = 5
+DEFAULT_HEARTBEAT_TIMEOUT = 20   # a dead connection is detected within this many seconds
+MIN_PING_DEADLINE = 5             # a ping answered later than this marks the server as lagging
 DEFAULT_PORTS = {'t':'50001', 's':'50002', 'h':'8081', 'g':'8082'}
 
+# outgoing requests are sent by priority class, highest first.
+# (name, methods, max requests in flight); unlisted methods go in the first class
+PRIORITY_CLASSES = [
+    ('broadcast', ['blockchain.transaction.broadcast'], None),
+    ('headers', ['blockchain.headers.subscribe', 'blockchain.numblocks.subscribe',
+                 'blockchain.block.get_header', 'blockchain.block.get_chunk'], 10),
+    ('merkle', ['blockchain.transaction.get_merkle'], 50),
+    ('history', ['blockchain.address.subscribe', 'blockchain.address.get_history'], 100),
+    ('tx', ['blockchain.transaction.get'], 50),
+]
+MAX_BACKLOG = 1000   # queued requests per class before send() blocks the caller
+
 DEFAULT_SERVERS = {
     'the9ull.homelinux.org': {'h': '8082', 't': '50001'},
     'electrum.coinwallet.me': {'h': '8081', 's': '50002', 't': '50001', 'g': '8082'},
@@ -62,6 +77,13 @@ def pick_random_server():
     return random.choice( filter_protocol(DEFAULT_SERVERS,'s') )
 
 
+def request_priority(method):
+    for i, (name, methods, limit) in enumerate(PRIORITY_CLASSES):
+        if method in methods:
+            return i
+    return 0
+
+
 
 
 class Interface(threading.Thread):
@@ -78,6 +100,12 @@ class Interface(threading.Thread):
         #json
         self.message_id = 0
         self.unanswered_requests = {}
+        self.send_queues = [ deque() for c in PRIORITY_CLASSES ]
+        self.in_flight = [ 0 for c in PRIORITY_CLASSES ]
+        #heartbeat
+        self.ping_id = None
+        self.ping_time = 0
+        self.last_recv = time.time()
         #banner
         self.banner = ''
         self.pending_transactions_for_notifications= []
@@ -128,6 +156,7 @@ class Interface(threading.Thread):
             if msg_id is not None:
                 with self.lock: 
                     method, params, channel = self.unanswered_requests.pop(msg_id)
+                    self.request_done(method)
                 response_queue = self.responses[channel]
                 response_queue.put((self,{'method':method, 'params':params, 'error':error, 'id':msg_id}))
 
@@ -136,8 +165,14 @@ class Interface(threading.Thread):
         if msg_id is not None:
             with self.lock: 
                 method, params, channel = self.unanswered_requests.pop(msg_id)
+                self.request_done(method)
             result = c.get('result')
 
+            if msg_id == self.ping_id:
+                self.server_version = result
+                self.on_pong()
+                return
+
             if method == 'server.version':
                 self.server_version = result
 
@@ -318,13 +353,18 @@ class Interface(threading.Thread):
             s.setproxy(proxy_modes.index(self.proxy["mode"]) + 1, self.proxy["host"], int(self.proxy["port"]) )
 
         if self.use_ssl:
-            s = ssl.wrap_socket(s, ssl_version=ssl.PROTOCOL_SSLv23, do_handshake_on_connect=True)
+            s = ssl.wrap_socket(s, ssl_version=ssl.PROTOCOL_SSLv23, do_handshake_on_connect=False)
             
         s.settimeout(2)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
         try:
             s.connect(( self.host.encode('ascii'), int(self.port)))
+            if self.use_ssl:
+                t1 = time.time()
+                s.do_handshake()
+                self.handshake_time = time.time() - t1
+                print_error("ssl handshake", self.host, "%.3fs"%self.handshake_time)
         except:
             #traceback.print_exc(file=sys.stdout)
             print_error("failed to connect", host, port)
@@ -332,7 +372,7 @@ class Interface(threading.Thread):
             self.s = None
             return
 
-        s.settimeout(60)
+        s.settimeout(1)
         self.s = s
         self.is_connected = True
 
@@ -358,10 +398,10 @@ class Interface(threading.Thread):
                         raise
 
                 if timeout:
-                    # ping the server with server.version, as a real ping does not exist yet
-                    self.send([('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])])
+                    self.heartbeat()
                     continue
 
+                self.last_recv = time.time()
                 out += msg
                 self.bytes_received += len(msg)
                 if msg == '': 
@@ -381,23 +421,143 @@ class Interface(threading.Thread):
         self.is_connected = False
 
 
+    def ping(self):
+        # ping the server with server.version, as a real ping does not exist yet
+        ids = self.send([('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])])
+        if ids:
+            self.ping_id = ids[0]
+            self.ping_time = time.time()
+
+
+    def on_pong(self):
+        # smoothed round-trip time and its mean deviation, as in TCP (rfc 6298)
+        sample = time.time() - self.ping_time
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample/2
+        else:
+            self.rtt_var = 0.75*self.rtt_var + 0.25*abs(self.rtt - sample)
+            self.rtt = 0.875*self.rtt + 0.125*sample
+        self.rtime = self.rtt
+        self.ping_id = None
+        self.is_lagging = False
+
+
+    def ping_deadline(self):
+        bound = self.heartbeat_timeout/2.
+        if self.rtt is None:
+            return bound
+        return min(bound, max(MIN_PING_DEADLINE, self.rtt + 4*self.rtt_var))
+
+
+    def heartbeat(self):
+        """called when the socket is idle. sends a ping every heartbeat_timeout/2
+        seconds of silence. a server that does not answer it in time is
+        lagging; one that sends nothing for heartbeat_timeout is dropped"""
+        now = time.time()
+        if self.ping_id is None:
+            if now - self.last_recv > self.heartbeat_timeout/2.:
+                self.ping()
+            return
+
+        # data received after the ping means the server is alive, only busy
+        waited = now - max(self.ping_time, self.last_recv)
+        if waited > self.heartbeat_timeout:
+            print_error("ping timeout", self.server, "%.1fs"%waited)
+            self.is_connected = False
+        elif waited > self.ping_deadline() and not self.is_lagging:
+            # stalled: still connected, but not a good candidate for the main server
+            print_error("lagging", self.server, "%.1fs"%waited)
+            self.is_lagging = True
+
+
     def send_tcp(self, messages, channel='default'):
-        """return the ids of the requests that we sent"""
-        out = ''
+        """queue requests in their priority class and return their ids.
+        blocks the caller while the backlog of a class is full.
+        must be called with self.lock held"""
         ids = []
         for m in messages:
             method, params = m 
-            request = json.dumps( { 'id':self.message_id, 'method':method, 'params':params } )
+            p = request_priority(method)
+            while len(self.send_queues[p]) >= MAX_BACKLOG and self.is_connected:
+                self.send_cond.wait(1)
+            if not self.is_connected:
+                return None
             self.unanswered_requests[self.message_id] = method, params, channel
+            self.send_queues[p].append( (self.message_id, method, params) )
             ids.append(self.message_id)
-            # uncomment to debug
-            # print "-->", request
             self.message_id += 1
-            out += request + '\n'
+
+        self.send_cond.notify_all()
+        return ids
+
+
+    def dispatch_tcp(self):
+        """pop the queued requests that can be sent now, highest priority
+        first, as long as their class has room in flight.
+        must be called with self.lock held"""
+        sent = []
+        for p, (name, methods, limit) in enumerate(PRIORITY_CLASSES):
+            q = self.send_queues[p]
+            while q and (limit is None or self.in_flight[p] < limit):
+                sent.append( (p, q.popleft()) )
+                self.in_flight[p] += 1
+        if sent:
+            self.send_cond.notify_all()
+        return sent
+
+
+    def requeue_tcp(self, sent):
+        # put back requests that could not be written. must be called with self.lock held
+        for p, request in reversed(sent):
+            self.send_queues[p].appendleft(request)
+            self.in_flight[p] = max(0, self.in_flight[p] - 1)
+        self.send_cond.notify_all()
+
+
+    def request_done(self, method):
+        # a slot is free in the class of that request. must be called with self.lock held
+        if self.protocol not in 'st':
+            return
+        p = request_priority(method)
+        self.in_flight[p] = max(0, self.in_flight[p] - 1)
+        self.send_cond.notify_all()
+
+
+    def run_sender(self):
+        """write the queued requests to the socket. this is the only thread
+        that writes, so the reader thread never blocks on a send"""
+        while self.is_connected:
+            with self.lock:
+                sent = self.dispatch_tcp()
+                if not sent:
+                    self.send_cond.wait(1)
+                    continue
+            out = ''
+            for p, (_id, method, params) in sent:
+                request = json.dumps( { 'id':_id, 'method':method, 'params':params } )
+                # uncomment to debug
+                # print "-->", request
+                out += request + '\n'
+            if not self.write_tcp(out):
+                with self.lock:
+                    self.requeue_tcp(sent)
+                self.is_connected = False
+        with self.lock:
+            self.send_cond.notify_all()
+
+
+    def write_tcp(self, out):
+        t1 = time.time()
         while out:
             try:
                 sent = self.s.send( out )
                 out = out[sent:]
+            except socket.timeout:
+                if time.time() - t1 < self.heartbeat_timeout:
+                    continue
+                print_error( "send timed out", self.server )
+                return False
             except socket.error,e:
                 if e[0] in (errno.EWOULDBLOCK,errno.EAGAIN):
                     print_error( "EAGAIN: retrying")
@@ -407,8 +567,8 @@ class Interface(threading.Thread):
                     traceback.print_exc(file=sys.stdout)
                     # this happens when we get disconnected
                     print_error( "Not connected, cannot send" )
-                    return None
-        return ids
+                    return False
+        return True
 
 
 
@@ -430,9 +590,15 @@ class Interface(threading.Thread):
         self.responses['default'] = Queue.Queue()
 
         self.lock = threading.Lock()
+        self.send_cond = threading.Condition(self.lock)
 
         self.servers = {} # actual list from IRC
         self.rtime = 0
+        self.rtt = None
+        self.rtt_var = 0
+        self.is_lagging = False
+        self.heartbeat_timeout = int(config.get('heartbeat_timeout', DEFAULT_HEARTBEAT_TIMEOUT))
+        self.handshake_time = 0         # duration of the last ssl handshake
         self.bytes_received = 0
         self.is_connected = False
 
@@ -599,9 +765,15 @@ class Interface(threading.Thread):
     def run(self):
         self.init_interface()
         if self.is_connected:
-            self.send([('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])])
+            self.ping()
             self.change_status()
-            self.run_tcp() if self.protocol in 'st' else self.run_http()
+            if self.protocol in 'st':
+                sender = threading.Thread(target=self.run_sender)
+                sender.daemon = True
+                sender.start()
+                self.run_tcp()
+            else:
+                self.run_http()
         self.change_status()
         
     def change_status(self):
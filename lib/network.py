@@ -27,6 +27,12 @@ class Network(threading.Thread):
             self.callbacks[event].append(callback)
 
 
+    def unregister_callback(self, event, callback):
+        with self.lock:
+            if callback in self.callbacks.get(event, []):
+                self.callbacks[event].remove(callback)
+
+
     def trigger_callback(self, event):
         with self.lock:
             callbacks = self.callbacks.get(event,[])[:]
@@ -48,11 +54,29 @@ class Network(threading.Thread):
     def start_interface(self, server):
         if server in self.interfaces.keys():
             return
-        i = interface.Interface({'server':server})
+        i = interface.Interface({'server':server, 'heartbeat_timeout':self.config.get('heartbeat_timeout', interface.DEFAULT_HEARTBEAT_TIMEOUT)})
         i.network = self # fixme
         self.interfaces[server] = i
         i.start(self.queue)
 
+    def best_interface(self):
+        """connected interface with the lowest round-trip time, preferring
+        servers that agree with the blockchain consensus and are not lagging"""
+        candidates = filter(lambda i: i.is_connected, self.interfaces.values())
+        if not candidates:
+            return
+        divergent = self.blockchain.get_divergent_servers()
+        unknown = 1e9
+        return min(candidates, key=lambda i: (i.server in divergent, i.is_lagging, i.rtt if i.rtt is not None else unknown))
+
+    def get_server_status(self):
+        """server -> connection status, round-trip time and duration of
+        the ssl handshake, in seconds, of each interface"""
+        status = {}
+        for server, i in self.interfaces.items():
+            status[server] = { 'connected':i.is_connected, 'lagging':i.is_lagging, 'rtt':i.rtt, 'handshake_time':i.handshake_time }
+        return status
+
     def start_random_interface(self):
         server = self.random_server()
         if server:
@@ -97,6 +121,7 @@ class Network(threading.Thread):
             i = self.queue.get()
 
             if i.is_connected:
+                self.blockchain.server_connected(i.server)
                 i.register_channel('verifier', self.blockchain.queue)
                 i.register_channel('get_header')
                 i.send([ ('blockchain.headers.subscribe',[])], 'verifier')
@@ -111,7 +136,7 @@ class Network(threading.Thread):
                 
                 if i == self.interface:
                     if self.config.get('auto_cycle'):
-                        self.interface = random.choice(self.interfaces.values())
+                        self.interface = self.best_interface() or random.choice(self.interfaces.values())
                         self.config.set_key('server', self.interface.server, False)
                     else:
                         self.trigger_callback('disconnected')
@@ -1,5 +1,8 @@
 import json, ast
 import os, ast
+import atexit
+import threading
+from contextlib import contextmanager
 from util import user_dir, print_error
 
 from version import ELECTRUM_VERSION, SEED_VERSION
@@ -36,6 +39,12 @@ a SimpleConfig instance then reads the wallet file.
         # command-line options
         self.options_config = options
 
+        # keys set since the config file was last written
+        self.dirty = set()
+        self.batch_level = 0
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
         # init path
         self.init_path()
 
@@ -66,7 +75,35 @@ a SimpleConfig instance then reads the wallet file.
 
         else:
             self.user_config[key] = value
-            if save: self.save_user_config()
+            if save:
+                with self.lock:
+                    self.dirty.add(key)
+                    if self.batch_level:
+                        return
+                self.flush()
+
+
+    @contextmanager
+    def batch(self):
+        """keys set in the batch are written once, when it ends"""
+        with self.lock:
+            self.batch_level += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_level -= 1
+                done = self.batch_level == 0
+            if done:
+                self.flush()
+
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = set()
+            self.save_user_config()
 
 
 
@@ -156,9 +193,14 @@ a SimpleConfig instance then reads the wallet file.
 
         path = os.path.join(self.path, "config")
         s = repr(self.user_config)
-        f = open(path,"w")
-        f.write( s )
-        f.close()
+        tmp = path + '.tmp'
+        with open(tmp,"w") as f:
+            f.write( s )
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
         if self.get('gui') != 'android':
             import stat
             os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
@@ -24,6 +24,9 @@ from bitcoin import *
 from util import print_error
 import time
 import struct
+import array
+import atexit
+import threading
 
 #
 # Workalike python implementation of Bitcoin's CDataStream class.
@@ -296,6 +299,22 @@ def match_decoded(decoded, to_match):
     return True
 
 def get_address_from_input_script(bytes):
+    # standard scripts are recognized by their layout; the others are
+    # decoded with script_GetOp
+    n = len(bytes)
+    if n:
+        l1 = ord(bytes[0])
+        if 0 < l1 <= 75:
+            # payto_pubkey: a signature
+            if n == 1 + l1:
+                return None, None, "(pubkey)"
+            # a signature and a public key
+            if n > 1 + l1:
+                l2 = ord(bytes[1 + l1])
+                if l2 in (33, 65) and n == 2 + l1 + l2:
+                    return None, None, public_key_to_bc_address(bytes[2 + l1:])
+
+    bytes = str(bytes)
     try:
         decoded = [ x for x in script_GetOp(bytes) ]
     except:
@@ -346,6 +365,19 @@ def get_address_from_input_script(bytes):
 
 
 def get_address_from_output_script(bytes):
+    # standard scripts are recognized by their layout
+    n = len(bytes)
+    # DUP HASH160 20 BYTES:... EQUALVERIFY CHECKSIG
+    if n == 25 and bytes[:3] == '\x76\xa9\x14' and bytes[23:] == '\x88\xac':
+        return False, hash_160_to_bc_address(bytes[3:23])
+    # HASH160 20 BYTES:... EQUAL
+    if n == 23 and bytes[:2] == '\xa9\x14' and bytes[22] == '\x87':
+        return False, hash_160_to_bc_address(bytes[2:22],5)
+    # 33 or 65 BYTES:... CHECKSIG
+    if n in (35, 67) and ord(bytes[0]) == n - 2 and bytes[-1] == '\xac':
+        return True, public_key_to_bc_address(bytes[1:-1])
+
+    bytes = str(bytes)
     decoded = [ x for x in script_GetOp(bytes) ]
 
     # The Genesis Block, self-payments, and pay-by-IP-address payments look like:
@@ -368,16 +400,294 @@ def get_address_from_output_script(bytes):
     return False, "(None)"
 
 
-class Transaction:
+def read_compact_size(data, i):
+    size = ord(data[i])
+    i += 1
+    if size == 253:
+        return struct.unpack_from('<H', data, i)[0], i + 2
+    elif size == 254:
+        return struct.unpack_from('<I', data, i)[0], i + 4
+    elif size == 255:
+        return struct.unpack_from('<Q', data, i)[0], i + 8
+    return size, i
+
+
+def parse_transaction(data, start=0):
+    """decode the tx that starts at offset start of data, a str or a
+    buffer. scripts are read through buffers, without copying the tx.
+    returns the decoded fields and the offset where the tx ends"""
+    try:
+        d = {}
+        d['version'] = struct.unpack_from('<i', data, start)[0]
+        n_vin, i = read_compact_size(data, start + 4)
+        inputs = []
+        for k in xrange(n_vin):
+            txin = {}
+            txin['prevout_hash'] = hash_encode(data[i:i+32])
+            txin['prevout_n'] = struct.unpack_from('<I', data, i + 32)[0]
+            size, i = read_compact_size(data, i + 36)
+            scriptSig = buffer(data, i, size)
+            i += size
+            txin['sequence'] = struct.unpack_from('<I', data, i)[0]
+            i += 4
+            if size:
+                pubkeys, signatures, address = get_address_from_input_script(scriptSig)
+            else:
+                pubkeys = []
+                signatures = []
+                address = None
+            txin['address'] = address
+            txin['signatures'] = signatures
+            inputs.append(txin)
+        d['inputs'] = inputs
+
+        n_vout, i = read_compact_size(data, i)
+        outputs = []
+        for k in xrange(n_vout):
+            txout = {}
+            txout['value'] = struct.unpack_from('<q', data, i)[0]
+            size, i = read_compact_size(data, i + 8)
+            scriptPubKey = buffer(data, i, size)
+            i += size
+            is_pubkey, address = get_address_from_output_script(scriptPubKey)
+            txout['is_pubkey'] = is_pubkey
+            txout['address'] = address
+            txout['raw_output_script'] = str(scriptPubKey).encode('hex')
+            txout['index'] = k
+            outputs.append(txout)
+        d['outputs'] = outputs
+
+        d['lockTime'] = struct.unpack_from('<I', data, i)[0]
+        i += 4
+    except (IndexError, struct.error):
+        raise SerializationError("attempt to read past end of buffer")
+    if i > len(data):
+        raise SerializationError("attempt to read past end of buffer")
+    return d, i
+
+
+def parse_record(data):
+    """TxRecord of a serialized tx. the input scripts are skipped: they
+    are only needed for the input addresses, that are found when the
+    inputs are first used"""
+    try:
+        n_vin, i = read_compact_size(data, 4)
+        prevouts = []
+        for k in xrange(n_vin):
+            prevouts.append( (data[i:i+32][::-1], struct.unpack_from('<I', data, i + 32)[0]) )
+            size, i = read_compact_size(data, i + 36)
+            i += size + 4
+        n_vout, i = read_compact_size(data, i)
+        outputs = []
+        for k in xrange(n_vout):
+            value = struct.unpack_from('<q', data, i)[0]
+            size, i = read_compact_size(data, i + 8)
+            script = buffer(data, i, size)
+            i += size
+            is_pubkey, address = get_address_from_output_script(script)
+            outputs.append( (value, script, is_pubkey, address) )
+    except (IndexError, struct.error):
+        raise SerializationError("attempt to read past end of buffer")
+    if i + 4 > len(data):
+        raise SerializationError("attempt to read past end of buffer")
+    return TxRecord(prevouts, None, outputs)
+
+
+# output script types in TxRecord
+TYPE_ADDRESS, TYPE_P2SH, TYPE_PUBKEY, TYPE_OTHER = range(4)
+# output values; doubles hold any amount of satoshis exactly
+VALUE_TYPECODE = 'l' if array.array('l').itemsize >= 8 else 'd'
+
+
+class TxRecord(object):
+    """what the wallet needs of a decoded transaction, in compact form.
+    addresses are interned, so that they are shared between txs.
+    in_addresses is None until the input scripts are decoded"""
+
+    __slots__ = ('prevout_hashes', 'prevout_ns', 'in_addresses', 'values', 'out_addresses', 'out_types', 'out_scripts')
+
+    def __init__(self, prevouts, in_addresses, outputs):
+        """prevouts: (prevout hash as bytes, n). outputs: (value, script, is_pubkey, address)"""
+        self.prevout_hashes = [ h for h, n in prevouts ]
+        self.prevout_ns = array.array('I', [ n for h, n in prevouts ])
+        self.in_addresses = None
+        if in_addresses is not None:
+            self.set_input_addresses(in_addresses)
+        self.values = array.array(VALUE_TYPECODE, [ o[0] for o in outputs ])
+        self.out_addresses = [ intern(o[3]) for o in outputs ]
+        self.out_types = array.array('B')
+        self.out_scripts = None         # index -> script, for scripts that cannot be rebuilt from the address
+        for k, (value, script, is_pubkey, address) in enumerate(outputs):
+            if is_pubkey:
+                t = TYPE_PUBKEY
+            elif len(script) == 25 and script[:3] == '\x76\xa9\x14' and script[23:] == '\x88\xac':
+                t = TYPE_ADDRESS
+            elif len(script) == 23 and script[:2] == '\xa9\x14' and script[22] == '\x87':
+                t = TYPE_P2SH
+            else:
+                t = TYPE_OTHER
+            if t in [TYPE_PUBKEY, TYPE_OTHER]:
+                if self.out_scripts is None: self.out_scripts = {}
+                self.out_scripts[k] = str(script)
+            self.out_types.append(t)
+
+    @classmethod
+    def from_decoded(klass, inputs, outputs):
+        """record of the inputs and outputs of a decoded tx"""
+        prevouts = [ (i['prevout_hash'].decode('hex'), i['prevout_n']) for i in inputs ]
+        outputs = [ (o['value'], o['raw_output_script'].decode('hex'), o['is_pubkey'], o['address']) for o in outputs ]
+        return klass(prevouts, [ i['address'] for i in inputs ], outputs)
+
+    def set_input_addresses(self, addresses):
+        self.in_addresses = [ intern(a) if a else None for a in addresses ]
+
+    def __getstate__(self):
+        return [ getattr(self, k) for k in self.__slots__ ]
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+    def get_prevouts(self):
+        return [ (h.encode('hex'), n) for h, n in zip(self.prevout_hashes, self.prevout_ns) ]
+
+    def get_inputs(self):
+        return [ { 'prevout_hash':h.encode('hex'), 'prevout_n':n, 'address':a } for h, n, a in zip(self.prevout_hashes, self.prevout_ns, self.in_addresses) ]
+
+    def get_outputs(self):
+        return zip(self.out_addresses, map(int, self.values))
+
+    def get_output(self, i):
+        address = self.out_addresses[i]
+        t = self.out_types[i]
+        if t == TYPE_ADDRESS:
+            script = '76a914' + bc_address_to_hash_160(address)[1].encode('hex') + '88ac'
+        elif t == TYPE_P2SH:
+            script = 'a914' + bc_address_to_hash_160(address)[1].encode('hex') + '87'
+        else:
+            script = self.out_scripts[i].encode('hex')
+        return { 'value':int(self.values[i]), 'address':address, 'is_pubkey':t == TYPE_PUBKEY, 'raw_output_script':script, 'index':i }
+
+
+
+class Transaction(object):
+
+    __slots__ = ('raw_bytes', '_d', '_inputs', '_outputs', '_record', 'input_info', 'is_complete', 'txlist')
     
-    def __init__(self, raw):
-        self.raw = raw
-        self.deserialize()
-        self.inputs = self.d['inputs']
-        self.outputs = self.d['outputs']
-        self.outputs = map(lambda x: (x['address'],x['value']), self.outputs)
+    def __init__(self, raw, raw_bytes=None):
+        # the transaction is kept serialized as bytes; raw is its hex
+        if raw_bytes is not None:
+            self.raw_bytes = raw_bytes
+        else:
+            self.raw = raw
+        # decoded when first used
+        self._d = None
+        self._inputs = None
+        self._outputs = None
+        self._record = None
         self.input_info = None
         self.is_complete = True
+        # txs of the wallet, to find the address of pay-to-pubkey inputs
+        # when the input scripts of a compact tx are decoded
+        self.txlist = None
+
+    @property
+    def d(self):
+        if self._d is not None:
+            return self._d
+        if self._record is not None:
+            # compact tx: decoded again on each access, and not kept.
+            # input addresses found by add_extra_addresses come from the record
+            d = self.deserialize()
+            self._d = None
+            if self._record.in_addresses is not None:
+                for i, address in zip(d['inputs'], self._record.in_addresses):
+                    i['address'] = address
+            return d
+        return self.deserialize()
+
+    @property
+    def inputs(self):
+        if self._inputs is None:
+            if self._record is not None:
+                # compact tx: built on each access, and not kept
+                if self._record.in_addresses is None:
+                    self.find_input_addresses()
+                return self._record.get_inputs()
+            self._inputs = self.d['inputs']
+        return self._inputs
+
+    @inputs.setter
+    def inputs(self, inputs):
+        self._inputs = inputs
+
+    @property
+    def outputs(self):
+        if self._outputs is None:
+            if self._record is not None:
+                return self._record.get_outputs()
+            self._outputs = map(lambda x: (x['address'],x['value']), self.d['outputs'])
+        return self._outputs
+
+    @outputs.setter
+    def outputs(self, outputs):
+        self._outputs = outputs
+
+    def is_decoded(self):
+        return self._d is not None or self._record is not None
+
+    def compact(self):
+        """keep only a TxRecord of the tx. if the tx was not decoded, its
+        input scripts are left for later. the inputs and outputs views
+        are built from the record when they are used"""
+        if self._record is None:
+            if self._d is not None:
+                self._record = TxRecord.from_decoded(self.inputs, self._d['outputs'])
+            else:
+                self._record = parse_record(self.raw_bytes)
+            self._d = self._inputs = self._outputs = None
+        return self._record
+
+    def find_input_addresses(self):
+        # decode the input scripts of a compact tx
+        d, end = parse_transaction(self.raw_bytes)
+        addresses = [ i['address'] for i in d['inputs'] ]
+        if self.txlist is not None:
+            for k, (prevout_hash, prevout_n) in enumerate(self._record.get_prevouts()):
+                if addresses[k] == "(pubkey)":
+                    prev_tx = self.txlist.get(prevout_hash)
+                    if prev_tx:
+                        addresses[k] = prev_tx.get_output_address(prevout_n)
+        self._record.set_input_addresses(addresses)
+
+    def get_prevouts(self):
+        """(prevout_hash, prevout_n) of the inputs. does not decode the
+        input scripts of a compact tx"""
+        if self._record is not None:
+            return self._record.get_prevouts()
+        return [ (i['prevout_hash'], i['prevout_n']) for i in self.inputs ]
+
+    def get_output(self, i):
+        """output i as a dict, like the ones in d['outputs']"""
+        if self._record is not None:
+            return self._record.get_output(i)
+        return self.d['outputs'][i]
+
+    def get_output_address(self, i):
+        if self._record is not None:
+            return self._record.out_addresses[i]
+        return self.outputs[i][0]
+
+    def get_num_outputs(self):
+        if self._record is not None:
+            return len(self._record.values)
+        return len(self.outputs)
+
+    def get_pubkey_outputs(self):
+        """indexes of the pay-to-pubkey outputs"""
+        if self._record is not None:
+            return [ i for i, t in enumerate(self._record.out_types) if t == TYPE_PUBKEY ]
+        return [ o['index'] for o in self.d['outputs'] if o['is_pubkey'] ]
         
     @classmethod
     def from_io(klass, inputs, outputs):
@@ -393,6 +703,18 @@ class Transaction:
         self.input_info = extras
         return self
 
+    @classmethod
+    def from_bytes(klass, raw_bytes):
+        return klass(None, raw_bytes)
+
+    @property
+    def raw(self):
+        return self.raw_bytes.encode('hex')
+
+    @raw.setter
+    def raw(self, raw):
+        self.raw_bytes = raw.decode('hex')
+
     def __str__(self):
         return self.raw
 
@@ -497,7 +819,7 @@ class Transaction:
 
 
     def hash(self):
-        return Hash(self.raw.decode('hex') )[::-1].encode('hex')
+        return Hash(self.raw_bytes)[::-1].encode('hex')
 
 
 
@@ -543,63 +865,21 @@ class Transaction:
 
 
     def deserialize(self):
-        vds = BCDataStream()
-        vds.write(self.raw.decode('hex'))
-        d = {}
-        start = vds.read_cursor
-        d['version'] = vds.read_int32()
-        n_vin = vds.read_compact_size()
-        d['inputs'] = []
-        for i in xrange(n_vin):
-            d['inputs'].append(self.parse_input(vds))
-        n_vout = vds.read_compact_size()
-        d['outputs'] = []
-        for i in xrange(n_vout):
-            d['outputs'].append(self.parse_output(vds, i))
-        d['lockTime'] = vds.read_uint32()
-        self.d = d
-        return self.d
-    
-
-    def parse_input(self, vds):
-        d = {}
-        d['prevout_hash'] = hash_encode(vds.read_bytes(32))
-        d['prevout_n'] = vds.read_uint32()
-        scriptSig = vds.read_bytes(vds.read_compact_size())
-        d['sequence'] = vds.read_uint32()
-
-        if scriptSig:
-            pubkeys, signatures, address = get_address_from_input_script(scriptSig)
-        else:
-            pubkeys = []
-            signatures = []
-            address = None
-
-        d['address'] = address
-        d['signatures'] = signatures
-        return d
-
-
-    def parse_output(self, vds, i):
-        d = {}
-        d['value'] = vds.read_int64()
-        scriptPubKey = vds.read_bytes(vds.read_compact_size())
-        is_pubkey, address = get_address_from_output_script(scriptPubKey)
-        d['is_pubkey'] = is_pubkey
-        d['address'] = address
-        d['raw_output_script'] = scriptPubKey.encode('hex')
-        d['index'] = i
+        d, end = parse_transaction(self.raw_bytes)
+        self._d = d
         return d
 
 
     def add_extra_addresses(self, txlist):
-        for i in self.inputs:
+        for k, i in enumerate(self.inputs):
             if i.get("address") == "(pubkey)":
                 prev_tx = txlist.get(i.get('prevout_hash'))
                 if prev_tx:
-                    address, value = prev_tx.outputs[i.get('prevout_n')]
+                    address = prev_tx.get_output_address(i.get('prevout_n'))
                     print_error("found pay-to-pubkey address:", address)
                     i["address"] = address
+                    if self._record is not None:
+                        self._record.in_addresses[k] = intern(address)
 
 
     def has_address(self, addr):
@@ -696,7 +976,7 @@ class Transaction:
     def requires_fee(self, verifier):
         # see https://en.bitcoin.it/wiki/Transaction_fees
         threshold = 57600000
-        size = len(self.raw)/2
+        size = len(self.raw_bytes)
         if size >= 10000: 
             return True
 
@@ -713,3 +993,62 @@ class Transaction:
         return priority < threshold 
 
 
+
+
+
+# parallel decoding. below PARALLEL_MIN txs, starting the work costs more
+# than decoding them here.
+PARALLEL_MIN = 20
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+def decode_raw(raw_bytes):
+    """decoded fields of a serialized tx. runs in the worker processes"""
+    return Transaction.from_bytes(raw_bytes).deserialize()
+
+def decode_record(raw_bytes):
+    return parse_record(raw_bytes)
+
+def start_pool(workers):
+    """start the worker processes used by decode_transactions. this forks,
+    so it should be called before other threads are started"""
+    global _pool, _pool_size
+    if workers < 2:
+        return
+    with _pool_lock:
+        if _pool is not None:
+            return
+        import multiprocessing
+        _pool = multiprocessing.Pool(workers)
+        _pool_size = workers
+    atexit.register(stop_pool)
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        pool = _pool
+        _pool = None
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def decode_transactions(raw_list, compact=False):
+    """Transactions from a list of serialized txs. If the pool is started,
+    they are decoded by its worker processes, into TxRecords without
+    input addresses if compact is set; otherwise, or if that fails, they
+    are decoded when first used."""
+    txs = [ Transaction.from_bytes(b) for b in raw_list ]
+    pool = _pool
+    if pool is not None and len(txs) >= PARALLEL_MIN:
+        try:
+            ds = pool.map(decode_record if compact else decode_raw, raw_list, max(1, len(raw_list)/(4*_pool_size)))
+        except Exception as e:
+            print_error("parallel decoding failed:", e)
+            ds = []
+        for tx, d in zip(txs, ds):
+            if compact:
+                tx._record = d
+            else:
+                tx._d = d
+    return txs
@@ -17,11 +17,126 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading, time, Queue, os, sys, shutil
+import threading, time, Queue, os, sys, shutil, bisect, collections
 from util import user_dir, appdata_dir, print_error
 from bitcoin import *
 
 
+# verifications are written to the wallet file in batches. if we crash
+# before a batch is written, its merkle branches are requested again.
+SAVE_INTERVAL = 10     # seconds
+SAVE_SIZE = 500        # unsaved verifications
+
+# number of snapshots that remember the txs changed since the previous one
+SNAPSHOT_HISTORY = 1000
+
+
+REMOVED = object()
+
+class FrozenDict(object):
+    """ immutable mapping, made of layers of changes, the newest first.
+    update() returns a new mapping that shares the older layers. layers are
+    merged like the digits of a binary counter, so there are O(log n) of
+    them and each entry is copied O(log n) times """
+
+    def __init__(self, layers=()):
+        self.layers = layers
+
+    def get(self, key, default=None):
+        for layer in self.layers:
+            if key in layer:
+                v = layer[key]
+                return default if v is REMOVED else v
+        return default
+
+    def __getitem__(self, key):
+        v = self.get(key, REMOVED)
+        if v is REMOVED:
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, key):
+        return self.get(key, REMOVED) is not REMOVED
+
+    def update(self, changes):
+        """ changes: {key: value, or REMOVED} """
+        if not changes:
+            return self
+        layers = (dict(changes),) + self.layers
+        while len(layers) > 1 and 2*len(layers[0]) >= len(layers[1]):
+            merged = dict(layers[1])
+            merged.update(layers[0])
+            if len(layers) == 2:
+                # bottom layer: removed entries can be dropped
+                merged = dict( (k, v) for k, v in merged.iteritems() if v is not REMOVED )
+            layers = (merged,) + layers[2:]
+        return FrozenDict(layers)
+
+
+
+class ConfirmationSnapshot(object):
+    """ immutable view of the verified and monitored transactions. the
+    verifier replaces it as a whole when they change, so readers do not need
+    its lock """
+
+    def __init__(self, version, verified_tx, transactions, blockchain, previous=None, changed=()):
+        self.version = version
+        self.verified_tx = verified_tx        # FrozenDict
+        self.transactions = transactions      # FrozenDict
+        self.blockchain = blockchain
+        self.previous = previous              # the snapshot this one replaced; cut by the verifier
+        self.changed = changed                # txs changed since the previous snapshot
+
+    def changed_since(self, version):
+        """ txs whose verification or height changed since the snapshot of
+        that version, or None if it is not known anymore """
+        changed = set()
+        s = self
+        while s.version != version:
+            if s.previous is None:
+                return None
+            changed.update(s.changed)
+            s = s.previous
+        return changed
+
+    def get_confirmations(self, tx):
+        """ return the number of confirmations of a monitored transaction. """
+        if tx in self.verified_tx:
+            height, timestamp, pos = self.verified_tx[tx]
+            conf = (self.blockchain.local_height - height + 1)
+            if conf <= 0: timestamp = None
+
+        elif tx in self.transactions:
+            conf = -1
+            timestamp = None
+
+        else:
+            conf = 0
+            timestamp = None
+
+        return conf, timestamp
+
+    def get_txpos(self, tx_hash):
+        "return position, even if the tx is unverified"
+        x = self.verified_tx.get(tx_hash)
+        y = self.transactions.get(tx_hash)
+        if x:
+            height, timestamp, pos = x
+            return height, pos
+        elif y:
+            return y, 0
+        else:
+            return 1e12, 0
+
+    def get_height(self, tx_hash):
+        v = self.verified_tx.get(tx_hash)
+        height = v[0] if v else None
+        return height
+
+
+# for wallets that have no verifier
+NO_CONFIRMATIONS = ConfirmationSnapshot(-1, FrozenDict(), FrozenDict(), None)
+
 
 
 class TxVerifier(threading.Thread):
@@ -38,60 +153,77 @@ class TxVerifier(threading.Thread):
         self.interface.register_channel('txverifier')
         self.verified_tx     = storage.get('verified_tx3',{})      # height, timestamp of verified transactions
         self.merkle_roots    = storage.get('merkle_roots',{})      # hashed by me
+        self.pending         = []                                  # monitored transactions that need a merkle branch
+        self.requested_merkle = set()
+        self.unsaved = set()                                       # txs whose verification is not written yet
+        self.last_save = time.time()
         self.lock = threading.Lock()
         self.running = False
 
+        # verified transactions indexed by height, for cheap rollbacks
+        self.heights = []                                          # sorted heights that have verified transactions
+        self.height_txs = {}                                       # height -> set of tx_hash
+        for tx_hash, (tx_height, timestamp, pos) in self.verified_tx.items():
+            self.index_tx(tx_hash, tx_height)
 
-    def get_confirmations(self, tx):
-        """ return the number of confirmations of a monitored transaction. """
-        with self.lock:
-            if tx in self.verified_tx:
-                height, timestamp, pos = self.verified_tx[tx]
-                conf = (self.blockchain.local_height - height + 1)
-                if conf <= 0: timestamp = None
+        network.register_callback('reorg', self.on_reorg)
+        # changes not published in the snapshot yet
+        self.verified_changes = {}
+        self.tx_changes = {}
+        self.snapshot = ConfirmationSnapshot(0, FrozenDict().update(self.verified_tx), FrozenDict(), self.blockchain)
+        self.snapshots = collections.deque([self.snapshot])         # the snapshots that have a previous one
 
-            elif tx in self.transactions:
-                conf = -1
-                timestamp = None
 
-            else:
-                conf = 0
-                timestamp = None
-
-        return conf, timestamp
+    def get_snapshot(self):
+        """ the current snapshot. readers that look up many transactions should
+        take it once and use it for the whole refresh """
+        return self.snapshot
 
+    def get_confirmations(self, tx):
+        return self.snapshot.get_confirmations(tx)
 
     def get_txpos(self, tx_hash):
-        "return position, even if the tx is unverified"
-        with self.lock:
-            x = self.verified_tx.get(tx_hash)
-            y = self.transactions.get(tx_hash)
-        if x:
-            height, timestamp, pos = x
-            return height, pos
-        elif y:
-            return y, 0
-        else:
-            return 1e12, 0
-
+        return self.snapshot.get_txpos(tx_hash)
 
     def get_height(self, tx_hash):
-        with self.lock:
-            v = self.verified_tx.get(tx_hash)
-        height = v[0] if v else None
-        return height
+        return self.snapshot.get_height(tx_hash)
+
+    def publish(self):
+        # must be called with self.lock held
+        s = self.snapshot
+        changed = frozenset(self.verified_changes) | frozenset(self.tx_changes)
+        self.snapshot = ConfirmationSnapshot(s.version + 1, s.verified_tx.update(self.verified_changes), s.transactions.update(self.tx_changes), self.blockchain, s, changed)
+        self.snapshots.append(self.snapshot)
+        if len(self.snapshots) > SNAPSHOT_HISTORY:
+            self.snapshots.popleft()
+            self.snapshots[0].previous = None
+        self.verified_changes = {}
+        self.tx_changes = {}
 
 
     def add(self, tx_hash, tx_height):
         """ add a transaction to the list of monitored transactions. """
         assert tx_height > 0
         with self.lock:
-            if tx_hash not in self.transactions.keys():
-                self.transactions[tx_hash] = tx_height
+            if tx_hash in self.transactions:
+                return
+            self.transactions[tx_hash] = tx_height
+            self.tx_changes[tx_hash] = tx_height
+            self.publish()
+            if tx_hash in self.verified_tx:
+                return
+            self.pending.append(tx_hash)
+        # wake up the verifier thread
+        self.interface.poke('txverifier')
+
+    def on_reorg(self):
+        self.undo_verifications(self.blockchain.reorg_height)
 
     def stop(self):
         with self.lock: self.running = False
-        #self.interface.poke('verifier')
+        self.network.unregister_callback('reorg', self.on_reorg)
+        self.interface.poke('txverifier')
+        self.save()
 
     def is_running(self):
         with self.lock: return self.running
@@ -99,71 +231,165 @@ class TxVerifier(threading.Thread):
     def run(self):
         with self.lock:
             self.running = True
-        requested_merkle = []
 
         while self.is_running():
-            # request missing tx
-            for tx_hash, tx_height in self.transactions.items():
-                if tx_hash not in self.verified_tx:
-                    if self.merkle_roots.get(tx_hash) is None and tx_hash not in requested_merkle:
-                        print_error('requesting merkle', tx_hash)
-                        self.interface.send([ ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) ], 'txverifier')
-                        requested_merkle.append(tx_hash)
-
-            try:
-                r = self.interface.get_response('txverifier',timeout=1)
-            except Queue.Empty:
-                continue
+            self.request_merkle()
+
+            # blocks until a response arrives, or until add() or stop() poke us.
+            # if some verifications are not saved, wait no longer than SAVE_INTERVAL
+            if self.unsaved:
+                timeout = max(0, self.last_save + SAVE_INTERVAL - time.time())
+                try:
+                    r = self.interface.get_response('txverifier', timeout=timeout)
+                except Queue.Empty:
+                    self.save()
+                    continue
+            else:
+                r = self.interface.get_response('txverifier')
             if not r: continue
 
-            if r.get('error'):
-                print_error('Verifier received an error:', r)
-                continue
-
-            # 3. handle response
-            method = r['method']
-            params = r['params']
-            result = r['result']
-
-            if method == 'blockchain.transaction.get_merkle':
-                tx_hash = params[0]
-                self.verify_merkle(tx_hash, result)
-                requested_merkle.remove(tx_hash)
-
-
-    def verify_merkle(self, tx_hash, result):
-        tx_height = result.get('block_height')
-        pos = result.get('pos')
-        self.merkle_roots[tx_hash] = self.hash_merkle_root(result['merkle'], tx_hash, pos)
-        header = self.blockchain.read_header(tx_height)
-        if not header: return
-        assert header.get('merkle_root') == self.merkle_roots[tx_hash]
-        # we passed all the tests
-        timestamp = header.get('timestamp')
+            # take the responses that are already there, to verify them per block
+            responses = [r]
+            while True:
+                try:
+                    r = self.interface.get_response('txverifier', block=False)
+                except Queue.Empty:
+                    break
+                if r: responses.append(r)
+
+            results = []
+            for r in responses:
+                if r.get('error'):
+                    print_error('Verifier received an error:', r)
+                    continue
+
+                # 3. handle response
+                method = r['method']
+                params = r['params']
+                result = r['result']
+
+                if method == 'blockchain.transaction.get_merkle':
+                    tx_hash = params[0]
+                    results.append( (tx_hash, result) )
+                    self.requested_merkle.discard(tx_hash)
+
+            if results:
+                self.verify_merkle(results)
+
+
+    def request_merkle(self):
+        """ request the merkle branches of the pending transactions, grouped by block """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            requests = []
+            for tx_hash in pending:
+                if tx_hash in self.verified_tx or tx_hash in self.requested_merkle:
+                    continue
+                if self.merkle_roots.get(tx_hash) is not None:
+                    continue
+                requests.append( ('blockchain.transaction.get_merkle',[tx_hash, self.transactions[tx_hash]]) )
+                self.requested_merkle.add(tx_hash)
+
+        if requests:
+            requests.sort(key=lambda x: x[1][1])
+            print_error('requesting %d merkle branches'%len(requests))
+            self.interface.send(requests, 'txverifier')
+
+
+    def verify_merkle(self, results):
+        """ verify a list of (tx_hash, merkle result). the header of each block
+        is read once, and the branches of a block share their merkle nodes """
+        blocks = {}
+        for tx_hash, result in results:
+            blocks.setdefault(result.get('block_height'), []).append( (tx_hash, result) )
+
+        verified = {}
+        for tx_height, items in sorted(blocks.items()):
+            header = self.blockchain.read_header(tx_height)
+            nodes = { 'root': header.get('merkle_root') } if header else None
+            for tx_hash, result in items:
+                pos = result.get('pos')
+                self.merkle_roots[tx_hash] = self.hash_merkle_root(result['merkle'], tx_hash, pos, nodes)
+                if not header: continue
+                assert header.get('merkle_root') == self.merkle_roots[tx_hash]
+                # we passed all the tests
+                verified[tx_hash] = (tx_height, header.get('timestamp'), pos)
+
+        if not verified: return
         with self.lock:
-            self.verified_tx[tx_hash] = (tx_height, timestamp, pos)
-        print_error("verified %s"%tx_hash)
-        self.storage.put('verified_tx3', self.verified_tx, True)
+            self.verified_tx.update(verified)
+            self.verified_changes.update(verified)
+            for tx_hash, (tx_height, timestamp, pos) in verified.items():
+                self.index_tx(tx_hash, tx_height)
+            self.unsaved.update(verified)
+            self.publish()
+        print_error("verified %d transactions"%len(verified))
+        if len(self.unsaved) >= SAVE_SIZE or time.time() - self.last_save >= SAVE_INTERVAL:
+            self.save()
         self.network.trigger_callback('updated')
 
 
-    def hash_merkle_root(self, merkle_s, target_hash, pos):
+    def save(self):
+        """ write the entries of verified_tx3 and merkle_roots that changed, in a single write """
+        with self.lock:
+            if not self.unsaved: return
+            with self.storage.batch():
+                for tx_hash in self.unsaved:
+                    v = self.verified_tx.get(tx_hash)
+                    # roots of unverified transactions are not saved, so that they are requested again
+                    if v is not None:
+                        self.storage.put_item('verified_tx3', tx_hash, v)
+                        self.storage.put_item('merkle_roots', tx_hash, self.merkle_roots.get(tx_hash))
+                    else:
+                        self.storage.pop_item('verified_tx3', tx_hash)
+                        self.storage.pop_item('merkle_roots', tx_hash)
+            self.unsaved = set()
+            self.last_save = time.time()
+
+
+    def hash_merkle_root(self, merkle_s, target_hash, pos, nodes=None):
+        """ nodes: merkle nodes of the branches already verified in the same
+        block, as {(level, index): hash}, and the expected root. we stop as
+        soon as the branch joins one of them; if the root is correct, the
+        nodes of this branch are added """
         h = hash_decode(target_hash)
+        path = []
         for i in range(len(merkle_s)):
+            if nodes is not None and nodes.get((i, pos >> i)) == h:
+                return nodes['root']
+            path.append( ((i, pos >> i), h) )
             item = merkle_s[i]
             h = Hash( hash_decode(item) + h ) if ((pos >> i) & 1) else Hash( h + hash_decode(item) )
-        return hash_encode(h)
+        root = hash_encode(h)
+        if nodes is not None and nodes['root'] == root:
+            nodes.update(path)
+        return root
+
+
 
+    def index_tx(self, tx_hash, tx_height):
+        # must be called with self.lock held
+        txs = self.height_txs.get(tx_height)
+        if txs is None:
+            txs = self.height_txs[tx_height] = set()
+            bisect.insort(self.heights, tx_height)
+        txs.add(tx_hash)
 
 
     def undo_verifications(self, height):
+        """ forget the verifications at height and above, and request them again """
         with self.lock:
-            items = self.verified_tx.items()[:]
-        for tx_hash, item in items:
-            tx_height, timestamp, pos = item
-            if tx_height >= height:
-                print_error("redoing", tx_hash)
-                with self.lock:
-                    self.verified_tx.pop(tx_hash)
-                    if tx_hash in self.merkle_roots:
-                        self.merkle_roots.pop(tx_hash)
+            i = bisect.bisect_left(self.heights, height)
+            for tx_height in self.heights[i:]:
+                for tx_hash in self.height_txs.pop(tx_height):
+                    print_error("redoing", tx_hash)
+                    self.verified_tx.pop(tx_hash, None)
+                    self.verified_changes[tx_hash] = REMOVED
+                    self.merkle_roots.pop(tx_hash, None)
+                    self.unsaved.add(tx_hash)
+                    if tx_hash in self.transactions:
+                        self.pending.append(tx_hash)
+            del self.heights[i:]
+            self.publish()
+        self.interface.poke('txverifier')
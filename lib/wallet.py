@@ -29,16 +29,37 @@ import random
 import aes
 import Queue
 import time
+import bisect
+import zlib
+import atexit
+from contextlib import contextmanager
 
 from util import print_msg, print_error, format_satoshis
 from bitcoin import *
 from account import *
-from transaction import Transaction
+from transaction import Transaction, decode_transactions
 
 # AES encryption
 EncodeAES = lambda secret, s: base64.b64encode(aes.encryptData(secret,s))
 DecodeAES = lambda secret, e: aes.decryptData(secret, base64.b64decode(e))
 
+# raw transactions are stored as base64 of their bytes, zlib-compressed
+# when it makes them smaller. older wallets stored them in hex.
+def encode_tx(tx):
+    b = tx.raw_bytes
+    z = zlib.compress(b)
+    if len(z) < len(b):
+        return ':z' + base64.b64encode(z)
+    return ':b' + base64.b64encode(b)
+
+def decode_tx_bytes(s):
+    if s.startswith(':z'):
+        return zlib.decompress(base64.b64decode(s[2:]))
+    if s.startswith(':b'):
+        return base64.b64decode(s[2:])
+    return s.decode('hex')
+
+
 def pw_encode(s, password):
     if password:
         secret = Hash(password)
@@ -64,72 +85,462 @@ def pw_decode(s, password):
 from version import ELECTRUM_VERSION, SEED_VERSION
 
 
+# mutations are appended to a journal next to the wallet file, and replayed
+# when the wallet is opened. the journal is compacted into the wallet file
+# when it grows larger than COMPACT_SIZE and than the wallet file itself,
+# when the wallet file does not exist yet, and when the storage is closed.
+COMPACT_SIZE = 1000000
+
+# the wallet file is written in sections, that are read when one of their
+# keys is first used. keys that are not listed here go in the 'keys' section.
+#   electrum-sections-1
+#   {section: (offset, length)}
+#   repr of the keys of each section
+WALLET_FORMAT = 'electrum-sections-1'
+SECTIONS = {
+    'labels': ['labels'],
+    'histories': ['addr_history'],
+    'transactions': ['transactions'],
+    'verification': ['verified_tx3', 'merkle_roots'],
+}
+SECTION_OF = dict( (k, name) for name, keys in SECTIONS.items() for k in keys )
+SECTION_NAMES = ['keys'] + sorted(SECTIONS.keys())
+
+
+def get_wallet_path(config):
+    path = config.get('wallet_path')
+    if not path:
+        path = config.get('default_wallet_path')
+    if path is not None:
+        return path
+    return os.path.join(config.path, "electrum.dat")
+
+
+
 class WalletStorage:
 
     def __init__(self, config):
         self.data = {}
         self.file_exists = False
+        self.lock = threading.Lock()
+        self.unsaved = []           # records of put(save=False), written with the next save
+        self.batch_level = 0
+        self.batch_changes = {}     # thread -> [(record, undo)] logged by that thread in a batch
+        self.journal_size = 0
+        self.snapshot_size = 0
+        self.compacting = False
+        self.section_lock = threading.RLock()
+        self.index = {}             # section -> (offset, length) in the wallet file
+        self.data_start = 0
+        self.loaded = set(SECTION_NAMES)
         self.init_path(config)
         print_error( "wallet path", self.path )
         if self.path:
             self.read(self.path)
+        atexit.register(self.close)
 
 
     def init_path(self, config):
         """Set the path of the wallet."""
+        self.path = get_wallet_path(config)
 
-        path = config.get('wallet_path')
-        if not path:
-            path = config.get('default_wallet_path')
-        if path is not None:
-            self.path = path
-            return
 
-        self.path = os.path.join(config.path, "electrum.dat")
+    def journal_path(self):
+        return self.path + '.journal'
 
 
     def read(self, path):
-        """Read the contents of the wallet file."""
+        """Read the index of the wallet file, and replay its journal.
+        Sections are read when they are first used."""
         try:
-            with open(self.path, "r") as f:
-                data = f.read()
+            f = open(self.path, "rb")
         except IOError:
+            f = None
+
+        if f is not None:
+            with f:
+                first = f.readline()
+                try:
+                    if first.strip() == WALLET_FORMAT:
+                        self.index = ast.literal_eval( f.readline() )
+                        self.data_start = f.tell()
+                        self.loaded = set()
+                    else:
+                        # single dict, written by older versions
+                        self.data = ast.literal_eval( first + f.read() )
+                except:
+                    raise IOError("Cannot read wallet file.")
+            self.snapshot_size = os.path.getsize(self.path)
+            self.file_exists = True
+            self.load_section('keys')
+
+        self.replay_journal()
+
+
+    def load_section(self, name):
+        if name in self.loaded:
             return
+        with self.section_lock:
+            if name in self.loaded:
+                return
+            d = {}
+            offset, length = self.index.get(name, (0, 0))
+            if length:
+                with open(self.path, "rb") as f:
+                    f.seek(self.data_start + offset)
+                    try:
+                        d = ast.literal_eval( f.read(length) )
+                    except:
+                        raise IOError("Cannot read wallet file.")
+            self.data.update(d)
+            self.loaded.add(name)
+        print_error("wallet: loaded section", name)
+
+
+    def use(self, key):
+        self.load_section(SECTION_OF.get(key, 'keys'))
+
+
+    def replay_journal(self):
         try:
-            d = ast.literal_eval( data )  #parse raw data from reading wallet file
-        except:
-            raise IOError("Cannot read wallet file.")
+            f = open(self.journal_path(), "rb")
+        except IOError:
+            return
 
-        self.data = d
-        self.file_exists = True
+        n = 0
+        offset = 0
+        with f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    assert line.endswith('\n')
+                    record = ast.literal_eval(line)
+                except:
+                    # the last record was not completely written
+                    print_error("journal: ignoring truncated record")
+                    break
+                self.apply(record)
+                offset += len(line)
+                n += 1
+            truncated = line != ''
+
+        if truncated:
+            with open(self.journal_path(), "rb+") as f:
+                f.truncate(offset)
+        self.journal_size = offset
+
+        if n:
+            print_error("journal: replayed %d records"%n)
+            self.file_exists = True
+            # bring the wallet file up to date, so that a copy of it is complete
+            self.compacting = True
+            t = threading.Thread(target=self.compact)
+            t.daemon = True
+            t.start()
+
+
+    def apply(self, record):
+        op = record[0]
+        if op == 'batch':
+            for r in record[1]:
+                self.apply(r)
+            return
+        self.use(record[1])
+        if op == 'put':
+            self.data[record[1]] = record[2]
+        elif op == 'set':
+            if self.data.get(record[1]) is None:
+                self.data[record[1]] = {}
+            self.data[record[1]][record[2]] = record[3]
+        elif op == 'del':
+            self.data.get(record[1], {}).pop(record[2], None)
 
 
     def get(self, key, default=None):
+        self.use(key)
         return self.data.get(key, default)
 
     def put(self, key, value, save = True):
+        self.use(key)
+        undo = ('put', key, key in self.data, self.data.get(key)) if self.batch_level else None
+        self.data[key] = value
+        self.log(('put', key, value), save, undo)
+
+    def put_item(self, key, subkey, value, save = True):
+        """set one entry of a dict-valued key; only that entry is journaled"""
+        self.use(key)
+        undo = self.item_undo(key, subkey) if self.batch_level else None
+        if self.data.get(key) is None:
+            self.data[key] = {}
+        self.data[key][subkey] = value
+        self.log(('set', key, subkey, value), save, undo)
+
+    def pop_item(self, key, subkey, save = True):
+        self.use(key)
+        undo = self.item_undo(key, subkey) if self.batch_level else None
+        self.data.get(key, {}).pop(subkey, None)
+        self.log(('del', key, subkey), save, undo)
+
+    def item_undo(self, key, subkey):
+        d = self.data.get(key) or {}
+        return ('item', key, subkey, subkey in d, d.get(subkey))
+
+
+    def log(self, record, save, undo=None):
+        with self.lock:
+            self.unsaved.append(record)
+            changes = self.batch_changes.get(threading.current_thread())
+            if changes is not None:
+                changes.append( (record, undo) )
+            if not save or self.batch_level:
+                return
+        self.flush()
 
-        if self.data.get(key) is not None:
-            self.data[key] = value
-        else:
-            # add key to wallet config
-            self.data[key] = value
 
-        if save: 
-            self.write()
+    @contextmanager
+    def batch(self):
+        """saves are deferred until the end of the batch, and its
+        mutations are written as a single journal record. if the body
+        raises, the mutations it made are undone and are not written"""
+        me = threading.current_thread()
+        with self.lock:
+            self.batch_level += 1
+            changes = self.batch_changes.setdefault(me, [])
+            mark = len(changes)
+        try:
+            yield self
+        except:
+            self.rollback(changes, mark)
+            raise
+        finally:
+            with self.lock:
+                self.batch_level -= 1
+                done = self.batch_level == 0
+                if mark == 0:
+                    self.batch_changes.pop(me, None)
+            if done:
+                self.flush()
+
+
+    def rollback(self, changes, mark):
+        # undo the mutations logged by a batch since mark, newest first
+        with self.lock:
+            undone = changes[mark:]
+            del changes[mark:]
+            for record, undo in reversed(undone):
+                if undo[0] == 'put':
+                    op, key, had, old = undo
+                    if had:
+                        self.data[key] = old
+                    else:
+                        self.data.pop(key, None)
+                else:
+                    op, key, subkey, had, old = undo
+                    d = self.data.get(key)
+                    if d is None:
+                        continue
+                    if had:
+                        d[subkey] = old
+                    else:
+                        d.pop(subkey, None)
+            ids = set( id(record) for record, undo in undone )
+            self.unsaved = [ r for r in self.unsaved if id(r) not in ids ]
+
+
+    def flush(self):
+        with self.lock:
+            if not self.unsaved:
+                return
+            records = self.unsaved
+            self.unsaved = []
+            # one line per save, so that replay applies all of it or nothing
+            r = records[0] if len(records) == 1 else ('batch', records)
+            new_file = not os.path.exists(self.journal_path())
+            with open(self.journal_path(), "ab") as f:
+                f.write(repr(r) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+                self.journal_size = f.tell()
+            first = not self.snapshot_size
+            compact = not self.compacting and (first or self.journal_size > max(COMPACT_SIZE, self.snapshot_size))
+            if compact:
+                self.compacting = True
+
+        if new_file:
+            self.set_permissions(self.journal_path())
+        if compact and first:
+            # a new wallet is small; write its file now, so that it can be copied
+            self.compact()
+        elif compact:
+            t = threading.Thread(target=self.compact)
+            t.daemon = True
+            t.start()
 
 
     def write(self):
-        s = repr(self.data)
-        f = open(self.path,"w")
-        f.write( s )
-        f.close()
+        """write the whole wallet file, and empty the journal"""
+        with self.lock:
+            self.unsaved = []
+        self.compact()
+
+
+    def close(self):
+        """save, and fold the journal into the wallet file"""
+        self.flush()
+        if self.path and os.path.exists(self.journal_path()):
+            self.compact()
+
+
+    def compact(self):
+        with self.section_lock:
+            self._compact()
+
+    def _compact(self):
+        # sections that were not loaded are copied from the current file
+        blobs = []
+        with self.lock:
+            for name in SECTION_NAMES:
+                if name in self.loaded:
+                    if name == 'keys':
+                        d = dict( (k, v) for k, v in self.data.items() if k not in SECTION_OF )
+                    else:
+                        d = dict( (k, self.data[k]) for k in SECTIONS[name] if k in self.data )
+                    blobs.append( repr(d) )
+                else:
+                    offset, length = self.index.get(name, (0, 0))
+                    with open(self.path, "rb") as f:
+                        f.seek(self.data_start + offset)
+                        blobs.append( f.read(length) )
+            offset = self.journal_size
+
+        index = {}
+        n = 0
+        for name, blob in zip(SECTION_NAMES, blobs):
+            index[name] = (n, len(blob))
+            n += len(blob)
+        head = WALLET_FORMAT + '\n' + repr(index) + '\n'
+
+        # replace the wallet file atomically
+        tmp = self.path + '.tmp'
+        with open(tmp, "wb") as f:
+            f.write(head)
+            for blob in blobs:
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        self.index = index
+        self.data_start = len(head)
+        self.set_permissions(self.path)
+
+        # keep the records that were appended in the meantime
+        with self.lock:
+            self.snapshot_size = len(head) + n
+            self.compacting = False
+            if not os.path.exists(self.journal_path()):
+                return
+            with open(self.journal_path(), "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+            if tail:
+                with open(tmp, "wb") as f:
+                    f.write(tail)
+                if os.name == 'nt':
+                    os.remove(self.journal_path())
+                os.rename(tmp, self.journal_path())
+                self.set_permissions(self.journal_path())
+            else:
+                os.remove(self.journal_path())
+            self.journal_size = len(tail)
+        print_error("wallet file compacted", self.path)
+
+
+    def set_permissions(self, path):
         if self.get('gui') != 'android':
             import stat
-            os.chmod(self.path,stat.S_IREAD | stat.S_IWRITE)
+            os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+
+
+class LoadProfile:
+    """time spent in each phase of loading the transactions"""
+
+    def __init__(self):
+        self.phases = []
+        self.t = time.time()
+
+    def done(self, name, n):
+        t = time.time()
+        self.phases.append( (name, t - self.t, n) )
+        self.t = t
+
+    def report(self):
+        total = sum( dt for name, dt, n in self.phases )
+        return ', '.join( "%s %.3fs (%d)"%x for x in self.phases ) + ', total %.3fs'%total
 
 
-class Wallet:
+
+class Ledger:
+    """the relevant transactions of an account, ordered by position, with
+    their value and the running balance after each of them"""
+
+    def __init__(self):
+        self.keys = []          # sorted list of (pos, tx_hash)
+        self.pos = {}           # tx_hash -> pos
+        self.deltas = {}        # tx_hash -> (is_mine, value, fee)
+        self.balances = []      # running balances of the first entries
+        self.version = None     # version of the confirmation snapshot
+
+    def invalidate(self, i):
+        del self.balances[i:]
+
+    def remove(self, tx_hash):
+        if tx_hash not in self.pos:
+            return
+        i = bisect.bisect_left(self.keys, (self.pos.pop(tx_hash), tx_hash))
+        del self.keys[i]
+        self.deltas.pop(tx_hash)
+        self.invalidate(i)
+
+    def set(self, tx_hash, pos, delta):
+        if self.pos.get(tx_hash) == pos:
+            i = bisect.bisect_left(self.keys, (pos, tx_hash))
+        else:
+            self.remove(tx_hash)
+            i = bisect.bisect_left(self.keys, (pos, tx_hash))
+            self.keys.insert(i, (pos, tx_hash))
+            self.pos[tx_hash] = pos
+        if self.deltas.get(tx_hash) != delta:
+            self.deltas[tx_hash] = delta
+            self.invalidate(i)
+
+    def update_balances(self):
+        balance = self.balances[-1] if self.balances else 0
+        for pos, tx_hash in self.keys[len(self.balances):]:
+            value = self.deltas[tx_hash][1]
+            if value is not None:
+                balance += value
+            self.balances.append(balance)
+
+    def total(self):
+        self.update_balances()
+        return self.balances[-1] if self.balances else 0
+
+    def items(self, start=None, end=None):
+        """entries with start <= position < end"""
+        self.update_balances()
+        i = bisect.bisect_left(self.keys, (start, '')) if start is not None else 0
+        j = bisect.bisect_left(self.keys, (end, '')) if end is not None else len(self.keys)
+        for k in xrange(i, j):
+            pos, tx_hash = self.keys[k]
+            yield tx_hash, self.deltas[tx_hash], self.balances[k]
+
+
+
+class Wallet(object):
 
     def __init__(self, storage):
 
@@ -144,13 +555,11 @@ class Wallet:
         self.use_change            = storage.get('use_change',True)
         self.use_encryption        = storage.get('use_encryption', False)
         self.seed                  = storage.get('seed', '')               # encrypted
-        self.labels                = storage.get('labels', {})
         self.frozen_addresses      = storage.get('frozen_addresses',[])
         self.prioritized_addresses = storage.get('prioritized_addresses',[])
         self.addressbook           = storage.get('contacts', [])
 
         self.imported_keys         = storage.get('imported_keys',{})
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
 
         self.fee                   = int(storage.get('fee_per_kb',20000))
 
@@ -162,29 +571,23 @@ class Wallet:
         if self.seed_version < 4:
             raise ValueError("This wallet seed is deprecated.")
 
-        self.load_accounts()
-
-        self.transactions = {}
-        tx_list = self.storage.get('transactions',{})
-        for k,v in tx_list.items():
-            try:
-                tx = Transaction(v)
-            except:
-                print_msg("Warning: Cannot deserialize transactions. skipping")
-                continue
-
-            self.add_extra_addresses(tx)
-            self.transactions[k] = tx
+        # cached balances of addresses and accounts (None is the whole wallet)
+        self.addr_balance = {}
+        self.account_balance = {}
+        self.balance_lock = threading.RLock()
 
-        for h,tx in self.transactions.items():
-            if not self.check_new_tx(h, tx):
-                print_error("removing unreferenced tx", h)
-                self.transactions.pop(h)
+        # tx history of accounts, built on first use
+        self.ledgers = {}
+        self.ledger_dirty = set()   # txs whose value or position may have changed
 
+        self.load_accounts()
 
-        # not saved
-        self.prevout_values = {}     # my own transaction outputs
-        self.spent_outputs = []
+        # labels, history and transactions are read from storage when first used
+        self._labels = None
+        self._history = None
+        self._transactions = None
+        self.tx_loaded = False
+        self.load_lock = threading.RLock()
 
         # spv
         self.verifier = None
@@ -198,18 +601,184 @@ class Wallet:
         self.transaction_lock = threading.Lock()
         self.tx_event = threading.Event()
 
-        for tx_hash, tx in self.transactions.items():
-            self.update_tx_outputs(tx_hash)
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = self.storage.get('labels', {})
+        return self._labels
+
+    @property
+    def history(self):
+        # address -> list(txid, height)
+        if self._history is None:
+            history = self.storage.get('addr_history',{})
+            self._tx_addresses = {}
+            for addr, hist in history.items():
+                self.index_history(addr, hist)
+            self._history = history
+        return self._history
+
+    @property
+    def tx_addresses(self):
+        # txid -> set of addresses whose history references it
+        if self._history is None:
+            self.history
+        return self._tx_addresses
+
+    @property
+    def transactions(self):
+        if not self.tx_loaded:
+            self.load_transactions()
+        return self._transactions
+
+    @property
+    def prevout_values(self):
+        # my own transaction outputs
+        if not self.tx_loaded:
+            self.load_transactions()
+        return self._prevout_values
+
+    @property
+    def spenders(self):
+        # outpoint -> hash of the wallet tx that spends it, mine or not
+        if not self.tx_loaded:
+            self.load_transactions()
+        return self._spenders
+
+    @property
+    def coins(self):
+        # outpoint -> unspent output of one of my addresses
+        if not self.tx_loaded:
+            self.load_transactions()
+        return self._coins
+
+    @property
+    def addr_coins(self):
+        # address -> list of outpoints in history order, None if some of its txs are missing
+        if not self.tx_loaded:
+            self.load_transactions()
+        return self._addr_coins
+
+
+    def load_transactions(self):
+        with self.load_lock:
+            if self._transactions is not None:
+                return
+            # not saved
+            self._prevout_values = {}
+            self._spenders = {}
+            self._coins = {}
+            self._addr_coins = {}
+            # seen by this thread while it is being filled
+            self._transactions = {}
+
+            profile = LoadProfile()
+            tx_list = self.storage.get('transactions',{})
+            self.tx_addresses
+            profile.done('read', len(tx_list))
+
+            # txs that no history refers to are dropped before decoding them
+            for k in tx_list.keys():
+                if k not in self.tx_addresses:
+                    print_error("removing unreferenced tx", k)
+                    tx_list.pop(k)
+                    self.storage.pop_item('transactions', k, False)
+
+            raw_list = []
+            for k,v in tx_list.items():
+                try:
+                    raw_list.append( (k, decode_tx_bytes(v)) )
+                except:
+                    print_msg("Warning: Cannot deserialize transactions. skipping")
+            # only the outpoints and the outputs are read here; the input
+            # scripts are decoded when the inputs of a tx are first used
+            txs = decode_transactions([ b for k, b in raw_list ], compact=True)
+            for (k, b), tx in zip(raw_list, txs):
+                try:
+                    tx.compact()
+                except:
+                    print_msg("Warning: Cannot deserialize transactions. skipping")
+                    continue
+                tx.txlist = self._transactions
+                self._transactions[k] = tx
+            profile.done('decode', len(self._transactions))
+
+            for h,tx in self._transactions.items():
+                if not self.check_new_tx(h, tx):
+                    print_error("removing unreferenced tx", h)
+                    self._transactions.pop(h)
+                    self.storage.pop_item('transactions', h, False)
+            # only accepted txs are spenders
+            for h, tx in self._transactions.items():
+                self.index_spenders(h, tx)
+            profile.done('reconcile', len(self._transactions))
+
+            for tx_hash, tx in self._transactions.items():
+                self.add_tx_outputs(tx_hash)
+            for addr in self.history.keys():
+                self.update_coins(addr)
+            profile.done('outputs', len(self.history))
+
+            self.load_profile = profile.report()
+            print_error("wallet load:", self.load_profile)
+            print_error("address cache:", ', '.join( "%s %.0f%% of %d"%(k, 100*v['hit_rate'], v['hits'] + v['misses']) for k, v in sorted(address_cache_stats().items()) ))
+            self.tx_loaded = True
+
+
+    def index_spenders(self, tx_hash, tx):
+        for prevout_hash, prevout_n in tx.get_prevouts():
+            self.spenders[prevout_hash + ':%d'%prevout_n] = tx_hash
+
+
+    def get_spent_address(self, prevout_hash, prevout_n):
+        # address of an output spent by a tx, if the wallet has its tx
+        prev_tx = self.transactions.get(prevout_hash)
+        if prev_tx is not None and prevout_n < prev_tx.get_num_outputs():
+            return prev_tx.get_output_address(prevout_n)
+
+
+    def tx_has_address(self, tx, addr):
+        """like tx.has_address, but the addresses of the inputs are taken
+        from the outputs they spend, so that the input scripts of compact
+        txs are only decoded if a spent tx is missing"""
+        for address, value in tx.outputs:
+            if address == addr:
+                return True
+        for prevout_hash, prevout_n in tx.get_prevouts():
+            if prevout_hash not in self.transactions:
+                return tx.has_address(addr)
+            if self.get_spent_address(prevout_hash, prevout_n) == addr:
+                return True
+        return False
 
 
     def add_extra_addresses(self, tx):
         h = tx.hash()
         # find the address corresponding to pay-to-pubkey inputs
         tx.add_extra_addresses(self.transactions)
-        for o in tx.d.get('outputs'):
-            if o.get('is_pubkey'):
-                for tx2 in self.transactions.values():
-                    tx2.add_extra_addresses({h:tx})
+        for i in tx.get_pubkey_outputs():
+            tx2 = self.transactions.get(self.spenders.get(h + ':%d'%i))
+            if tx2:
+                tx2.add_extra_addresses({h:tx})
+
+
+    def index_history(self, addr, hist):
+        if hist == ['*']: return
+        for tx_hash, height in hist:
+            self._tx_addresses.setdefault(tx_hash, set()).add(addr)
+
+
+    def set_history(self, addr, hist):
+        old_hist = self.history.get(addr, [])
+        if old_hist != ['*']:
+            for tx_hash, height in old_hist:
+                s = self._tx_addresses.get(tx_hash)
+                if s is None: continue
+                s.discard(addr)
+                if not s: self._tx_addresses.pop(tx_hash)
+        self.history[addr] = hist
+        self.index_history(addr, hist)
 
             
 
@@ -238,12 +807,14 @@ class Wallet:
         
         # store the originally requested keypair into the imported keys table
         self.imported_keys[address] = pw_encode(sec, password )
+        self.address_index[address] = (-1, None)
         self.storage.put('imported_keys', self.imported_keys, True)
         return address
         
     def delete_imported_key(self, addr):
         if addr in self.imported_keys:
             self.imported_keys.pop(addr)
+            self.address_index.pop(addr, None)
             self.storage.put('imported_keys', self.imported_keys, True)
 
 
@@ -392,12 +963,13 @@ class Wallet:
 
     def set_label(self, key, value):
         self.labels[key] = value
-        self.storage.put('labels', self.labels, True)
+        self.storage.put_item('labels', key, value, True)
 
 
     def create_account(self, account_type = '1', name = None):
         account_id, account = self.next_account(account_type)
         self.accounts[account_id] = account
+        self.index_account(account_id)
         self.save_accounts()
         if name:
             self.set_label(account_id, name)
@@ -407,6 +979,7 @@ class Wallet:
         mpk = OldAccount.mpk_from_seed(self.seed)
         self.storage.put('master_public_key', mpk, True)
         self.accounts[0] = OldAccount({'mpk':mpk, 0:[], 1:[]})
+        self.index_account(0)
         self.save_accounts()
 
 
@@ -429,6 +1002,26 @@ class Wallet:
                 self.accounts[k] = BIP32_Account_2of2(v)
             else:
                 self.accounts[k] = BIP32_Account(v)
+        self.rebuild_address_index()
+
+
+    def rebuild_address_index(self):
+        # address -> (account, (for_change, n)), as returned by get_address_index
+        self.address_index = {}
+        for addr in self.imported_keys.keys():
+            self.address_index[addr] = (-1, None)
+        for account_id in self.accounts.keys():
+            self.index_account(account_id)
+        with self.balance_lock:
+            self.addr_balance = {}
+            self.account_balance = {}
+
+
+    def index_account(self, account_id):
+        account = self.accounts[account_id]
+        for for_change in [0,1]:
+            for n, addr in enumerate(account.get_addresses(for_change)):
+                self.address_index[addr] = (account_id, (for_change, n))
 
 
     def addresses(self, include_change = True, next=False):
@@ -444,7 +1037,7 @@ class Wallet:
 
 
     def is_mine(self, address):
-        return address in self.addresses(True)
+        return address in self.address_index
 
 
     def is_change(self, address):
@@ -473,17 +1066,10 @@ class Wallet:
 
 
     def get_address_index(self, address):
-        if address in self.imported_keys.keys():
-            return -1, None
-
-        for account in self.accounts.keys():
-            for for_change in [0,1]:
-                addresses = self.accounts[account].get_addresses(for_change)
-                for addr in addresses:
-                    if address == addr:
-                        return account, (for_change, addresses.index(addr))
-
-        raise BaseException("Address not found", address)
+        try:
+            return self.address_index[address]
+        except KeyError:
+            raise BaseException("Address not found", address)
 
 
     def rebase_sequence(self, account, sequence):
@@ -663,6 +1249,7 @@ class Wallet:
                 addresses = addresses[0:n]
                 self.accounts[key][0] = addresses
 
+            self.rebuild_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit, True)
             self.save_accounts()
@@ -709,22 +1296,29 @@ class Wallet:
         return age > 2
 
 
-    def synchronize_sequence(self, account, for_change):
+    def create_new_address(self, account_id, for_change):
+        account = self.accounts[account_id]
+        address = account.create_new_address(for_change)
+        self.address_index[address] = (account_id, (for_change, len(account.get_addresses(for_change)) - 1))
+        self.history[address] = []
+        return address
+
+
+    def synchronize_sequence(self, account_id, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
+        account = self.accounts[account_id]
         new_addresses = []
         while True:
             addresses = account.get_addresses(for_change)
             if len(addresses) < limit:
-                address = account.create_new_address(for_change)
-                self.history[address] = []
+                address = self.create_new_address(account_id, for_change)
                 new_addresses.append( address )
                 continue
 
             if map( lambda a: self.address_is_old(a), addresses[-limit:] ) == limit*[False]:
                 break
             else:
-                address = account.create_new_address(for_change)
-                self.history[address] = []
+                address = self.create_new_address(account_id, for_change)
                 new_addresses.append( address )
 
         return new_addresses
@@ -739,22 +1333,24 @@ class Wallet:
                 self.create_account(account_type)
 
 
-    def synchronize_account(self, account):
+    def synchronize_account(self, account_id):
         new = []
-        new += self.synchronize_sequence(account, 0)
-        new += self.synchronize_sequence(account, 1)
+        new += self.synchronize_sequence(account_id, 0)
+        new += self.synchronize_sequence(account_id, 1)
         return new
 
 
     def synchronize(self):
-        if self.master_public_keys:
-            self.create_pending_accounts()
-        new = []
-        for account in self.accounts.values():
-            new += self.synchronize_account(account)
-        if new:
-            self.save_accounts()
-            self.storage.put('addr_history', self.history, True)
+        with self.storage.batch():
+            if self.master_public_keys:
+                self.create_pending_accounts()
+            new = []
+            for account_id in self.accounts.keys():
+                new += self.synchronize_account(account_id)
+            if new:
+                for address in new:
+                    self.storage.put_item('addr_history', address, [], False)
+                self.save_accounts()
         return new
 
 
@@ -803,57 +1399,150 @@ class Wallet:
         return tx.get_value(domain, self.prevout_values)
 
     
-    def update_tx_outputs(self, tx_hash):
+    def add_tx_outputs(self, tx_hash):
         tx = self.transactions.get(tx_hash)
 
         for i, (addr, value) in enumerate(tx.outputs):
             key = tx_hash+ ':%d'%i
             self.prevout_values[key] = value
 
-        for item in tx.inputs:
-            if self.is_mine(item.get('address')):
-                key = item['prevout_hash'] + ':%d'%item['prevout_n']
-                self.spent_outputs.append(key)
+        # my coins spent by this tx
+        for prevout_hash, prevout_n in tx.get_prevouts():
+            key = prevout_hash + ':%d'%prevout_n
+            coin = self.coins.pop(key, None)
+            if coin is not None and self.addr_coins.get(coin['address']):
+                self.addr_coins[coin['address']].remove(key)
+
+
+    def get_spent_addresses(self, tx):
+        # my addresses whose outputs are spent by tx
+        out = set()
+        for prevout_hash, prevout_n in tx.get_prevouts():
+            addr = self.get_spent_address(prevout_hash, prevout_n)
+            if self.is_mine(addr):
+                out.add(addr)
+        return out
+
+
+    def update_tx_outputs(self, tx_hash):
+        tx = self.transactions.get(tx_hash)
+        self.index_spenders(tx_hash, tx)
+        self.add_tx_outputs(tx_hash)
+        addresses = set( addr for addr, value in tx.outputs if self.is_mine(addr) )
+        spending = self.get_spent_addresses(tx)
+        # addresses that were waiting for this tx
+        for addr in self.tx_addresses.get(tx_hash, []):
+            if addr in self.addr_coins and self.addr_coins[addr] is None:
+                addresses.add(addr)
+        for addr in addresses:
+            self.update_coins(addr)
+        self.invalidate_balance(spending)
+        self.invalidate_ledger(tx)
+
+
+    def update_coins(self, addr):
+        """recompute the unspent outputs of an address from its history.
+        they are kept in history order, so that coin selection does not
+        depend on dict ordering"""
+        coins = {}
+        keys = []
+        missing = False
+        h = self.history.get(addr, [])
+        if h != ['*']:
+            for tx_hash, tx_height in h:
+                tx = self.transactions.get(tx_hash)
+                if tx is None:
+                    missing = True
+                    continue
+                for i, (address, value) in enumerate(tx.outputs):
+                    if address != addr: continue
+                    key = tx_hash + ":%d" % i
+                    if self.spenders.get(key) in self.transactions: continue
+                    output = tx.get_output(i)
+                    output['tx_hash'] = tx_hash
+                    coins[key] = output
+                    keys.append(key)
+
+        for key in self.addr_coins.get(addr) or []:
+            self.coins.pop(key, None)
+        self.coins.update(coins)
+        self.addr_coins[addr] = None if missing else keys
+        self.invalidate_balance([addr])
+        if h != ['*']:
+            self.ledger_dirty.update( tx_hash for tx_hash, tx_height in h )
+
+
+    def remove_transaction(self, tx_hash):
+        tx = self.transactions.pop(tx_hash, None)
+        if tx is None:
+            return
+        addresses = set( addr for addr, value in tx.outputs if self.is_mine(addr) )
+        addresses |= self.get_spent_addresses(tx)
+        for prevout_hash, prevout_n in tx.get_prevouts():
+            key = prevout_hash + ':%d'%prevout_n
+            if self.spenders.get(key) == tx_hash:
+                self.spenders.pop(key)
+        for addr in addresses:
+            self.update_coins(addr)
+        self.invalidate_ledger(tx)
+
+
+    def invalidate_ledger(self, tx):
+        # the value of a tx depends on the outputs it spends
+        tx_hash = tx.hash()
+        self.ledger_dirty.add(tx_hash)
+        for i in xrange(tx.get_num_outputs()):
+            spender = self.spenders.get(tx_hash + ':%d'%i)
+            if spender:
+                self.ledger_dirty.add(spender)
+
+
+    def invalidate_balance(self, addresses):
+        with self.balance_lock:
+            for addr in addresses:
+                self.addr_balance.pop(addr, None)
+                if addr in self.address_index:
+                    self.account_balance.pop(self.address_index[addr][0], None)
+            self.account_balance.pop(None, None)
 
 
     def get_addr_balance(self, address):
         assert self.is_mine(address)
+        # loading takes balance_lock, so it must not run under it
+        if not self.tx_loaded: self.load_transactions()
+        with self.balance_lock:
+            b = self.addr_balance.get(address)
+            if b is None:
+                b = self.addr_balance[address] = self.compute_addr_balance(address)
+            return b
+
+
+    def compute_addr_balance(self, address):
+        """the coins received at address, minus those spent by a tx of its
+        history; each counted as confirmed if its tx is. the spending txs
+        are found in spenders, so that input scripts are not decoded"""
         h = self.history.get(address,[])
         if h == ['*']: return 0,0
+        heights = dict(h)
         c = u = 0
-        received_coins = []   # list of coins received at address
-
-        for tx_hash, tx_height in h:
-            tx = self.transactions.get(tx_hash)
-            if not tx: continue
-
-            for i, (addr, value) in enumerate(tx.outputs):
-                if addr == address:
-                    key = tx_hash + ':%d'%i
-                    received_coins.append(key)
 
         for tx_hash, tx_height in h:
             tx = self.transactions.get(tx_hash)
             if not tx: continue
-            v = 0
-
-            for item in tx.inputs:
-                addr = item.get('address')
-                if addr == address:
-                    key = item['prevout_hash']  + ':%d'%item['prevout_n']
-                    value = self.prevout_values.get( key )
-                    if key in received_coins: 
-                        v -= value
 
             for i, (addr, value) in enumerate(tx.outputs):
-                key = tx_hash + ':%d'%i
-                if addr == address:
-                    v += value
-
-            if tx_height:
-                c += v
-            else:
-                u += v
+                if addr != address:
+                    continue
+                if tx_height:
+                    c += value
+                else:
+                    u += value
+                spender = self.spenders.get(tx_hash + ':%d'%i)
+                if spender in heights and spender in self.transactions:
+                    if heights[spender]:
+                        c -= value
+                    else:
+                        u -= value
         return c, u
 
 
@@ -895,8 +1584,16 @@ class Wallet:
         return cc, uu
 
     def get_account_balance(self, account):
+        if not self.tx_loaded: self.load_transactions()
+        with self.balance_lock:
+            b = self.account_balance.get(account)
+            if b is None:
+                b = self.account_balance[account] = self.compute_account_balance(account)
+            return b
+
+    def compute_account_balance(self, account):
         if account is None:
-            return self.get_balance()
+            return self.compute_balance()
         elif account == -1:
             return self.get_imported_balance()
         
@@ -917,32 +1614,37 @@ class Wallet:
 
         
     def get_balance(self):
+        return self.get_account_balance(None)
+
+    def compute_balance(self):
         cc = uu = 0
         for a in self.accounts.keys():
             c, u = self.get_account_balance(a)
             cc += c
             uu += u
-        c, u = self.get_imported_balance()
+        c, u = self.get_account_balance(-1)
         cc += c
         uu += u
         return cc, uu
 
 
+    def get_addr_coins(self, addr):
+        if addr not in self.addr_coins:
+            return []
+        keys = self.addr_coins[addr]
+        if keys is None: raise BaseException("Wallet not synchronized")
+        return [ self.coins[key] for key in keys ]
+
+
+    def get_account_coins(self, account):
+        return self.get_unspent_coins(self.get_account_addresses(account))
+
+
     def get_unspent_coins(self, domain=None):
         coins = []
         if domain is None: domain = self.addresses(True)
         for addr in domain:
-            h = self.history.get(addr, [])
-            if h == ['*']: continue
-            for tx_hash, tx_height in h:
-                tx = self.transactions.get(tx_hash)
-                if tx is None: raise BaseException("Wallet not synchronized")
-                for output in tx.d.get('outputs'):
-                    if output.get('address') != addr: continue
-                    key = tx_hash + ":%d" % output.get('index')
-                    if key in self.spent_outputs: continue
-                    output['tx_hash'] = tx_hash
-                    coins.append(output)
+            coins += self.get_addr_coins(addr)
         return coins
 
 
@@ -1034,28 +1736,26 @@ class Wallet:
                 # may happen due to pruning
                 print_error("received transaction that is no longer referenced in history", tx_hash)
                 return
+            tx.compact()
             self.transactions[tx_hash] = tx
             self.interface.pending_transactions_for_notifications.append(tx)
-            self.save_transactions()
+            self.storage.put_item('transactions', tx_hash, encode_tx(tx), True)
             if self.verifier and tx_height>0: 
                 self.verifier.add(tx_hash, tx_height)
             self.update_tx_outputs(tx_hash)
 
 
-    def save_transactions(self):
-        tx = {}
-        for k,v in self.transactions.items():
-            tx[k] = str(v)
-        self.storage.put('transactions', tx, True)
-
     def receive_history_callback(self, addr, hist):
 
         if not self.check_new_history(addr, hist):
             raise BaseException("error: received history for %s is not consistent with known transactions"%addr)
             
         with self.lock:
-            self.history[addr] = hist
-            self.storage.put('addr_history', self.history, True)
+            self.set_history(addr, hist)
+            self.storage.put_item('addr_history', addr, hist, True)
+
+        with self.transaction_lock:
+            self.update_coins(addr)
 
         if hist != ['*']:
             for tx_hash, tx_height in hist:
@@ -1064,34 +1764,67 @@ class Wallet:
                     if self.verifier: self.verifier.add(tx_hash, tx_height)
 
 
-    def get_tx_history(self, account=None):
+    def get_tx_history(self, account=None, start=None, end=None):
+        """history of an account, optionally restricted to the txs with
+        start <= (height, pos) < end"""
+        if self.verifier:
+            snapshot = self.verifier.get_snapshot()
+        else:
+            from verifier import NO_CONFIRMATIONS
+            snapshot = NO_CONFIRMATIONS
         with self.transaction_lock:
-            history = self.transactions.items()
-            history.sort(key = lambda x: self.verifier.get_txpos(x[0]))
+            ledger = self.get_ledger(account, snapshot)
             result = []
-    
-            balance = 0
-            for tx_hash, tx in history:
-                is_relevant, is_mine, v, fee = self.get_tx_value(tx, account)
-                if v is not None: balance += v
 
+            # txs missing from the history, e.g. on a pruning server
             c, u = self.get_account_balance(account)
+            offset = c + u - ledger.total()
+            if offset != 0 and start is None:
+                result.append( ('', 1000, 0, offset, None, offset, None ) )
 
-            if balance != c+u:
-                result.append( ('', 1000, 0, c+u-balance, None, c+u-balance, None ) )
+            for tx_hash, (is_mine, value, fee), balance in ledger.items(start, end):
+                conf, timestamp = snapshot.get_confirmations(tx_hash)
+                result.append( (tx_hash, conf, is_mine, value, fee, balance + offset, timestamp) )
 
-            balance = c + u - balance
-            for tx_hash, tx in history:
-                is_relevant, is_mine, value, fee = self.get_tx_value(tx, account)
-                if not is_relevant:
-                    continue
-                if value is not None:
-                    balance += value
+        return result
 
-                conf, timestamp = self.verifier.get_confirmations(tx_hash) if self.verifier else (None, None)
-                result.append( (tx_hash, conf, is_mine, value, fee, balance, timestamp) )
 
-        return result
+    def get_ledger(self, account, snapshot):
+        if account not in self.ledgers:
+            ledger = Ledger()
+            domain = set(self.get_account_addresses(account))
+            for tx_hash in self.transactions.keys():
+                self.update_ledger(ledger, domain, tx_hash, snapshot)
+            ledger.version = snapshot.version
+            self.ledgers[account] = ledger
+
+        dirty = self.ledger_dirty
+        self.ledger_dirty = set()
+        for a, ledger in self.ledgers.items():
+            domain = set(self.get_account_addresses(a))
+            for tx_hash in dirty:
+                self.update_ledger(ledger, domain, tx_hash, snapshot)
+            # positions change when txs are verified
+            if ledger.version != snapshot.version:
+                moved = snapshot.changed_since(ledger.version)
+                if moved is None:
+                    moved = ledger.pos.keys()
+                for tx_hash in moved:
+                    if tx_hash in ledger.pos and tx_hash not in dirty:
+                        ledger.set(tx_hash, snapshot.get_txpos(tx_hash), ledger.deltas[tx_hash])
+            ledger.version = snapshot.version
+
+        return self.ledgers[account]
+
+
+    def update_ledger(self, ledger, domain, tx_hash, snapshot):
+        tx = self.transactions.get(tx_hash)
+        if tx is None:
+            return ledger.remove(tx_hash)
+        is_relevant, is_mine, v, fee = tx.get_value(domain, self.prevout_values)
+        if not is_relevant:
+            return ledger.remove(tx_hash)
+        ledger.set(tx_hash, snapshot.get_txpos(tx_hash), (is_mine, v, fee))
 
 
     def get_label(self, tx_hash):
@@ -1197,23 +1930,27 @@ class Wallet:
 
     def update_password(self, seed, old_password, new_password):
         if new_password == '': new_password = None
+        # encrypt everything first: a decoding error must not leave
+        # some keys under the old password and some under the new one.
         # this will throw an exception if unicode cannot be converted
-        self.seed = pw_encode( seed, new_password)
-        self.storage.put('seed', self.seed, True)
-        self.use_encryption = (new_password != None)
-        self.storage.put('use_encryption', self.use_encryption,True)
-        for k in self.imported_keys.keys():
-            a = self.imported_keys[k]
-            b = pw_decode(a, old_password)
-            c = pw_encode(b, new_password)
-            self.imported_keys[k] = c
-        self.storage.put('imported_keys', self.imported_keys, True)
-
+        seed = pw_encode( seed, new_password)
+        imported_keys = {}
+        for k, v in self.imported_keys.items():
+            imported_keys[k] = pw_encode( pw_decode(v, old_password), new_password)
+        master_private_keys = {}
         for k, v in self.master_private_keys.items():
-            b = pw_decode(v, old_password)
-            c = pw_encode(b, new_password)
-            self.master_private_keys[k] = c
-        self.storage.put('master_private_keys', self.master_private_keys, True)
+            master_private_keys[k] = pw_encode( pw_decode(v, old_password), new_password)
+
+        # written together, so that the seed and keys never use different passwords
+        with self.storage.batch():
+            self.seed = seed
+            self.storage.put('seed', self.seed, True)
+            self.use_encryption = (new_password != None)
+            self.storage.put('use_encryption', self.use_encryption,True)
+            self.imported_keys = imported_keys
+            self.storage.put('imported_keys', self.imported_keys, True)
+            self.master_private_keys = master_private_keys
+            self.storage.put('master_private_keys', self.master_private_keys, True)
 
 
     def freeze(self,addr):
@@ -1267,7 +2004,7 @@ class Wallet:
         vr = self.verifier.transactions.keys() + self.verifier.verified_tx.keys()
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
-                self.transactions.pop(tx_hash)
+                self.remove_transaction(tx_hash)
 
 
 
@@ -1278,23 +2015,18 @@ class Wallet:
             for tx_hash, height in hist:
                 tx = self.transactions.get(tx_hash)
                 if not tx: continue
-                if not tx.has_address(addr):
+                if not self.tx_has_address(tx, addr):
                     return False
 
         # check that we are not "orphaning" a transaction
         old_hist = self.history.get(addr,[])
         if old_hist == ['*']: return True
 
+        new_txs = set( x[0] for x in hist ) if hist != ['*'] else set()
         for tx_hash, height in old_hist:
-            if tx_hash in map(lambda x:x[0], hist): continue
-            found = False
-            for _addr, _hist in self.history.items():
-                if _addr == addr: continue
-                if _hist == ['*']: continue
-                _tx_hist = map(lambda x:x[0], _hist)
-                if tx_hash in _tx_hist:
-                    found = True
-                    break
+            if tx_hash in new_txs: continue
+            # referenced by another address
+            found = bool( self.tx_addresses.get(tx_hash, set()) - set([addr]) )
 
             if not found:
                 tx = self.transactions.get(tx_hash)
@@ -1325,7 +2057,7 @@ class Wallet:
                     self.verifier.add(tx_hash, height)
                 else:
                     print_error("removing orphaned tx from history", tx_hash)
-                    self.transactions.pop(tx_hash)
+                    self.remove_transaction(tx_hash)
 
         return True
 
@@ -1333,19 +2065,14 @@ class Wallet:
 
     def check_new_tx(self, tx_hash, tx):
         # 1 check that tx is referenced in addr_history. 
-        addresses = []
-        for addr, hist in self.history.items():
-            if hist == ['*']:continue
-            for txh, height in hist:
-                if txh == tx_hash: 
-                    addresses.append(addr)
+        addresses = self.tx_addresses.get(tx_hash, [])
 
         if not addresses:
             return False
 
         # 2 check that referencing addresses are in the tx
         for addr in addresses:
-            if not tx.has_address(addr):
+            if not self.tx_has_address(tx, addr):
                 return False
 
         return True
@@ -1454,80 +2181,98 @@ class WalletSynchronizer(threading.Thread):
                 self.interface.network.trigger_callback('updated')
                 self.was_updated = False
 
-            # 2. get a response
+            # 2. get a response, and the ones already queued
             r = self.interface.get_response('synchronizer')
 
             # poke sends None. (needed during stop)
             if not r: continue
 
-            # 3. handle response
-            method = r['method']
-            params = r['params']
-            result = r.get('result')
-            error = r.get('error')
-            if error:
-                print "error", r
-                continue
+            responses = [r]
+            while True:
+                try:
+                    r = self.interface.get_response('synchronizer', block=False)
+                except Queue.Empty:
+                    break
+                if r: responses.append(r)
 
-            if method == 'blockchain.address.subscribe':
-                addr = params[0]
-                if self.wallet.get_status(self.wallet.get_history(addr)) != result:
-                    if requested_histories.get(addr) is None:
-                        self.interface.send([('blockchain.address.get_history', [addr])], 'synchronizer')
-                        requested_histories[addr] = result
-
-            elif method == 'blockchain.address.get_history':
-                addr = params[0]
-                print_error("receiving history", addr, result)
-                if result == ['*']:
-                    assert requested_histories.pop(addr) == '*'
-                    self.wallet.receive_history_callback(addr, result)
-                else:
-                    hist = []
-                    # check that txids are unique
-                    txids = []
-                    for item in result:
-                        tx_hash = item['tx_hash']
-                        if tx_hash not in txids:
-                            txids.append(tx_hash)
-                            hist.append( (tx_hash, item['height']) )
-
-                    if len(hist) != len(result):
-                        raise BaseException("error: server sent history with non-unique txid", result)
-
-                    # check that the status corresponds to what was announced
-                    rs = requested_histories.pop(addr)
-                    if self.wallet.get_status(hist) != rs:
-                        raise BaseException("error: status mismatch: %s"%addr)
-                
-                    # store received history
-                    self.wallet.receive_history_callback(addr, hist)
-
-                    # request transactions that we don't have 
-                    for tx_hash, tx_height in hist:
-                        if self.wallet.transactions.get(tx_hash) is None:
-                            if (tx_hash, tx_height) not in requested_tx and (tx_hash, tx_height) not in missing_tx:
-                                missing_tx.append( (tx_hash, tx_height) )
-
-            elif method == 'blockchain.transaction.get':
-                tx_hash = params[0]
-                tx_height = params[1]
-                assert tx_hash == hash_encode(Hash(result.decode('hex')))
-                tx = Transaction(result)
-                self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-                self.was_updated = True
-                requested_tx.remove( (tx_hash, tx_height) )
-                print_error("received tx:", tx_hash, len(tx.raw))
-
-            elif method == 'blockchain.transaction.broadcast':
-                self.wallet.tx_result = result
-                self.wallet.tx_event.set()
+            # decode the received transactions together
+            tx_results = [ (r['params'][0], r.get('result')) for r in responses if r['method'] == 'blockchain.transaction.get' and r.get('result') ]
+            txs = decode_transactions([ result.decode('hex') for tx_hash, result in tx_results ])
+            decoded = dict( (tx_hash, tx) for (tx_hash, result), tx in zip(tx_results, txs) )
+
+            for r in responses:
+                self.handle_response(r, decoded, requested_tx, missing_tx, requested_histories)
+
+
+    def handle_response(self, r, decoded, requested_tx, missing_tx, requested_histories):
+        # 3. handle response
+        method = r['method']
+        params = r['params']
+        result = r.get('result')
+        error = r.get('error')
+        if error:
+            print "error", r
+            return
 
+        if method == 'blockchain.address.subscribe':
+            addr = params[0]
+            if self.wallet.get_status(self.wallet.get_history(addr)) != result:
+                if requested_histories.get(addr) is None:
+                    self.interface.send([('blockchain.address.get_history', [addr])], 'synchronizer')
+                    requested_histories[addr] = result
+
+        elif method == 'blockchain.address.get_history':
+            addr = params[0]
+            print_error("receiving history", addr, result)
+            if result == ['*']:
+                assert requested_histories.pop(addr) == '*'
+                self.wallet.receive_history_callback(addr, result)
             else:
-                print_error("Error: Unknown message:" + method + ", " + repr(params) + ", " + repr(result) )
+                hist = []
+                # check that txids are unique
+                txids = []
+                for item in result:
+                    tx_hash = item['tx_hash']
+                    if tx_hash not in txids:
+                        txids.append(tx_hash)
+                        hist.append( (tx_hash, item['height']) )
+
+                if len(hist) != len(result):
+                    raise BaseException("error: server sent history with non-unique txid", result)
+
+                # check that the status corresponds to what was announced
+                rs = requested_histories.pop(addr)
+                if self.wallet.get_status(hist) != rs:
+                    raise BaseException("error: status mismatch: %s"%addr)
+                
+                # store received history
+                self.wallet.receive_history_callback(addr, hist)
+
+                # request transactions that we don't have 
+                for tx_hash, tx_height in hist:
+                    if self.wallet.transactions.get(tx_hash) is None:
+                        if (tx_hash, tx_height) not in requested_tx and (tx_hash, tx_height) not in missing_tx:
+                            missing_tx.append( (tx_hash, tx_height) )
+
+        elif method == 'blockchain.transaction.get':
+            tx_hash = params[0]
+            tx_height = params[1]
+            assert tx_hash == hash_encode(Hash(result.decode('hex')))
+            tx = decoded.get(tx_hash) or Transaction(result)
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.was_updated = True
+            requested_tx.remove( (tx_hash, tx_height) )
+            print_error("received tx:", tx_hash, len(tx.raw_bytes))
+
+        elif method == 'blockchain.transaction.broadcast':
+            self.wallet.tx_result = result
+            self.wallet.tx_event.set()
 
-            if self.was_updated and not requested_tx:
-                self.interface.network.trigger_callback('updated')
-                self.interface.network.trigger_callback("new_transaction") # Updated gets called too many times from other places as well; if we use that signal we get the notification three times
+        else:
+            print_error("Error: Unknown message:" + method + ", " + repr(params) + ", " + repr(result) )
 
-                self.was_updated = False
+        if self.was_updated and not requested_tx:
+            self.interface.network.trigger_callback('updated')
+            self.interface.network.trigger_callback("new_transaction") # Updated gets called too many times from other places as well; if we use that signal we get the notification three times
+
+            self.was_updated = False
@@ -1,3 +1,5 @@
+import os
+
 class WalletFactory(object):
     def __new__(cls, config):
         if config.get('bitkey', False):
@@ -9,3 +11,21 @@ class WalletFactory(object):
         # Load standard wallet
         from wallet import Wallet
         return Wallet(config)
+
+
+class WalletStorageFactory(object):
+    def __new__(cls, config):
+        from wallet import WalletStorage, get_wallet_path
+        path = get_wallet_path(config)
+        if os.path.exists(path):
+            from wallet_sqlite import is_sqlite
+            sqlite = is_sqlite(path)
+        else:
+            # backend of new wallets
+            sqlite = config.get('wallet_storage') == 'sqlite'
+
+        if sqlite:
+            from wallet_sqlite import SqliteWalletStorage
+            return SqliteWalletStorage(config)
+
+        return WalletStorage(config)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2011 thomasv@gitorious
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import ast
+import sqlite3
+import threading
+
+from util import print_error
+from wallet import WalletStorage
+
+
+SQLITE_MAGIC = 'SQLite format 3\0'
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS transactions (tx_hash TEXT PRIMARY KEY, raw TEXT)",
+    "CREATE TABLE IF NOT EXISTS addr_history (address TEXT PRIMARY KEY, history TEXT)",
+    "CREATE TABLE IF NOT EXISTS verified_tx (tx_hash TEXT PRIMARY KEY, height INTEGER, timestamp INTEGER, pos INTEGER)",
+    "CREATE INDEX IF NOT EXISTS verified_tx_height ON verified_tx (height)",
+    "CREATE TABLE IF NOT EXISTS merkle_roots (tx_hash TEXT PRIMARY KEY, root TEXT)",
+    "CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, label TEXT)",
+]
+
+# dict-valued wallet keys that are stored one row per entry.
+# key -> (table, columns, row from value, value from row)
+TABLES = {
+    'transactions': ('transactions', ('tx_hash', 'raw'), lambda v: (v,), lambda r: r[0]),
+    'addr_history': ('addr_history', ('address', 'history'), lambda v: (repr(v),), lambda r: ast.literal_eval(r[0])),
+    'verified_tx3': ('verified_tx', ('tx_hash', 'height', 'timestamp', 'pos'), lambda v: tuple(v), lambda r: tuple(r)),
+    'merkle_roots': ('merkle_roots', ('tx_hash', 'root'), lambda v: (v,), lambda r: r[0]),
+    'labels': ('labels', ('key', 'label'), lambda v: (v,), lambda r: r[0]),
+}
+
+
+def decode_text(b):
+    """TEXT columns: ascii values are returned as str, others as unicode,
+    so that non-ascii labels read back like they do from the file storage"""
+    try:
+        b.decode('ascii')
+        return b
+    except UnicodeDecodeError:
+        return b.decode('utf-8')
+
+
+def is_sqlite(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except IOError:
+        return False
+
+
+
+class SqliteWalletStorage(WalletStorage):
+    """Wallet storage in an SQLite database.
+
+    get/put behave like the file storage; dict-valued keys listed in
+    TABLES are kept one row per entry, so put_item and pop_item update a
+    single row. Writes with save=False, or made during a batch, stay in
+    the open transaction until the next commit. A batch that fails undoes
+    its own writes, like the file storage. The database is in WAL mode,
+    so that another process can read it while the wallet is open."""
+
+    def read(self, path):
+        self.file_exists = os.path.exists(path)
+        self.db_lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = decode_text
+        with self.db_lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            for s in SCHEMA:
+                self.db.execute(s)
+            self.db.commit()
+            self.file_exists = self.file_exists and self.db.execute("SELECT count(*) FROM settings").fetchone()[0] > 0
+        if not self.file_exists:
+            self.set_permissions(path)
+
+
+    def row(self, key, subkey, value):
+        table, columns, to_row, from_row = TABLES[key]
+        return (subkey,) + to_row(value)
+
+
+    def get(self, key, default=None):
+        with self.db_lock:
+            if key in TABLES:
+                table, columns, to_row, from_row = TABLES[key]
+                c = self.db.execute("SELECT %s FROM %s"%(','.join(columns), table))
+                return dict( (r[0], from_row(r[1:])) for r in c )
+            r = self.db.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+        return ast.literal_eval(r[0]) if r else default
+
+    def get_item(self, key, subkey):
+        # (found, value) of one row of a table
+        table, columns, to_row, from_row = TABLES[key]
+        r = self.db.execute("SELECT %s FROM %s WHERE %s=?"%(','.join(columns[1:]), table, columns[0]), (subkey,)).fetchone()
+        return (True, from_row(r)) if r else (False, None)
+
+    def put(self, key, value, save = True):
+        with self.db_lock:
+            undo = ('put', key, self.get(key)) if self.batch_level else None
+            self.set_value(key, value)
+            self.log(('put', key), save, undo)
+
+    def put_item(self, key, subkey, value, save = True):
+        with self.db_lock:
+            if key not in TABLES:
+                d = self.get(key) or {}
+                d[subkey] = value
+                return self.put(key, d, save)
+            undo = ('item', key, subkey) + self.get_item(key, subkey) if self.batch_level else None
+            self.set_item(key, subkey, value)
+            self.log(('set', key, subkey), save, undo)
+
+    def pop_item(self, key, subkey, save = True):
+        with self.db_lock:
+            if key not in TABLES:
+                d = self.get(key) or {}
+                d.pop(subkey, None)
+                return self.put(key, d, save)
+            undo = ('item', key, subkey) + self.get_item(key, subkey) if self.batch_level else None
+            self.del_item(key, subkey)
+            self.log(('del', key, subkey), save, undo)
+
+
+    def set_value(self, key, value):
+        if key in TABLES:
+            # only the rows that differ are written
+            old = self.get(key)
+            value = value or {}
+            for k in old:
+                if k not in value:
+                    self.del_item(key, k)
+            for k, v in value.items():
+                if k not in old or old[k] != v:
+                    self.set_item(key, k, v)
+        elif value is not None:
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES (?,?)", (key, repr(value)))
+        else:
+            self.db.execute("DELETE FROM settings WHERE key=?", (key,))
+
+    def set_item(self, key, subkey, value):
+        table, columns, to_row, from_row = TABLES[key]
+        q = "INSERT OR REPLACE INTO %s VALUES (%s)"%(table, ','.join(['?']*len(columns)))
+        self.db.execute(q, self.row(key, subkey, value))
+
+    def del_item(self, key, subkey):
+        table, columns, to_row, from_row = TABLES[key]
+        self.db.execute("DELETE FROM %s WHERE %s=?"%(table, columns[0]), (subkey,))
+
+
+    def log(self, record, save, undo=None):
+        # writes stay in the open transaction; the record is only kept to undo a batch
+        with self.lock:
+            changes = self.batch_changes.get(threading.current_thread())
+            if changes is not None:
+                changes.append( (record, undo) )
+            if not save or self.batch_level:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.db_lock:
+            self.db.commit()
+
+    def rollback(self, changes, mark):
+        # undo the writes of this batch only, newest first. writes of other
+        # threads stay in the open transaction, and are committed with it
+        with self.db_lock:
+            with self.lock:
+                undone = changes[mark:]
+                del changes[mark:]
+            for record, undo in reversed(undone):
+                if undo[0] == 'put':
+                    op, key, old = undo
+                    self.set_value(key, old)
+                else:
+                    op, key, subkey, had, old = undo
+                    if had:
+                        self.set_item(key, subkey, old)
+                    else:
+                        self.del_item(key, subkey)
+
+
+    def write(self):
+        """commit, and move the write-ahead log into the database file"""
+        with self.db_lock:
+            self.db.commit()
+            self.db.execute("PRAGMA wal_checkpoint(FULL)")
+
+
+    def close(self):
+        self.write()
+
@@ -70,6 +70,7 @@ setup(name = "Electrum",
                   'electrum.wallet',
                   'electrum.wallet_bitkey',
                   'electrum.wallet_factory',
+                  'electrum.wallet_sqlite',
                   'electrum.bmp',
                   'electrum.i18n',
                   'electrum.pyqrnative',
@@ -0,0 +1,76 @@
+import os, sys, struct, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from bitcoin import public_key_to_bc_address, hash_160_to_bc_address
+from transaction import Transaction, decode_transactions, start_pool, stop_pool, PARALLEL_MIN
+
+
+PUBKEY = '\x02' + '\x11'*32
+
+def push(b):
+    return chr(len(b)) + b
+
+def serialize(inputs, outputs):
+    # inputs: (prevout_hash, prevout_n, scriptSig); outputs: (value, scriptPubKey)
+    s = struct.pack('<i', 1) + chr(len(inputs))
+    for prevout_hash, prevout_n, script in inputs:
+        s += prevout_hash.decode('hex')[::-1] + struct.pack('<I', prevout_n) + push(script) + '\xff'*4
+    s += chr(len(outputs))
+    for value, script in outputs:
+        s += struct.pack('<q', value) + push(script)
+    return s + '\x00'*4
+
+def p2pkh(h160):
+    return '\x76\xa9\x14' + h160 + '\x88\xac'
+
+
+class TestCompactTransaction(unittest.TestCase):
+
+    def setUp(self):
+        # a tx paying to a public key, and a tx spending that output
+        self.funding = Transaction.from_bytes(serialize([('ab'*32, 0, push('\x30'*72))], [(5000, push(PUBKEY) + '\xac')]))
+        self.spending = Transaction.from_bytes(serialize([(self.funding.hash(), 0, push('\x30'*72))], [(4000, p2pkh('\x22'*20))]))
+
+    def test_compact_keeps_resolved_pubkey_address(self):
+        address = public_key_to_bc_address(PUBKEY)
+        self.assertEqual(self.spending.inputs[0]['address'], '(pubkey)')
+        self.spending.add_extra_addresses({self.funding.hash(): self.funding})
+        self.spending.compact()
+        self.assertEqual(self.spending.inputs[0]['address'], address)
+        self.assertEqual(self.spending.d['inputs'][0]['address'], address)
+
+    def test_compact_views_are_not_kept(self):
+        self.spending.compact()
+        self.assertEqual(self.spending.outputs, [(hash_160_to_bc_address('\x22'*20), 4000)])
+        self.assertEqual(self.spending.inputs[0]['prevout_hash'], self.funding.hash())
+        self.assertTrue(self.spending._inputs is None and self.spending._outputs is None)
+        self.assertEqual(self.spending.get_output_address(0), hash_160_to_bc_address('\x22'*20))
+
+
+class TestDecodePool(unittest.TestCase):
+
+    def setUp(self):
+        start_pool(2)
+        raw = serialize([('ab'*32, 0, push('\x30'*72))], [(5000, push(PUBKEY) + '\xac'), (4000, p2pkh('\x22'*20))])
+        self.raw_list = [raw] * (2*PARALLEL_MIN)
+        self.expected = Transaction.from_bytes(raw)
+
+    def tearDown(self):
+        stop_pool()
+
+    def test_decode_in_workers(self):
+        for compact in [False, True]:
+            txs = decode_transactions(self.raw_list, compact=compact)
+            self.assertTrue(all(tx.is_decoded() for tx in txs))
+            self.assertTrue(all(tx.outputs == self.expected.outputs for tx in txs))
+            self.assertEqual(txs[0].hash(), self.expected.hash())
+
+    def test_decode_without_pool(self):
+        stop_pool()
+        txs = decode_transactions(self.raw_list)
+        self.assertFalse(any(tx.is_decoded() for tx in txs))
+        self.assertEqual(txs[0].outputs, self.expected.outputs)
+
+
+if __name__ == '__main__':
+    unittest.main()
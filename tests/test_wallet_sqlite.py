@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os, sys, shutil, tempfile, threading, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from wallet_sqlite import SqliteWalletStorage
+
+
+class TestSqliteWalletStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'wallet.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_non_ascii_label_round_trip(self):
+        s = SqliteWalletStorage({'wallet_path':self.path})
+        s.put_item('labels', 'tx1', u'caf\xe9')
+        s.put_item('labels', 'tx2', 'plain')
+        s.put('seed_version', 4)
+        s.write()
+
+        s = SqliteWalletStorage({'wallet_path':self.path})
+        labels = s.get('labels')
+        self.assertEqual(labels['tx1'], u'caf\xe9')
+        self.assertTrue(isinstance(labels['tx1'], unicode))
+        self.assertEqual(labels['tx2'], 'plain')
+        self.assertEqual(s.get('seed_version'), 4)
+
+    def test_failed_batch_undoes_only_its_writes(self):
+        s = SqliteWalletStorage({'wallet_path':self.path})
+        s.put_item('labels', 'tx1', 'old')
+        s.put('fee', 1000)
+        try:
+            with s.batch():
+                s.put_item('labels', 'tx1', 'new')
+                s.put_item('labels', 'tx2', 'new')
+                s.put('fee', 2000)
+                t = threading.Thread(target=s.put_item, args=('labels', 'tx3', 'other'))
+                t.start()
+                t.join()
+                raise ValueError
+        except ValueError:
+            pass
+
+        s = SqliteWalletStorage({'wallet_path':self.path})
+        self.assertEqual(s.get('labels'), {'tx1':'old', 'tx3':'other'})
+        self.assertEqual(s.get('fee'), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()